@@ -1,3 +1,5 @@
+import time
+started_at = time.perf_counter()
 import asyncio
 import datetime
 from typing import Optional
@@ -5,12 +7,16 @@ import discord
 from discord import app_commands, SelectOption
 import openai
 import os
-import json
 from action import ConversationCompletionAction
-from chatgpt import extract_datasource
+import chatgpt
 from db import Database, UserUnion
+from llm_metrics import metrics
 from discord_handler import DiscordHandler, DiscordSendable
-from dto import Conversation, Message
+from dto import Message
+from command_sync import sync_if_changed
+from message_queue import GatewayQueue
+from persona_cache import PersonaResponseCache
+from persona_registry import Persona, PersonaRegistry
 from sendable import Sendable
 from db import Database
 import asyncio
@@ -18,6 +24,8 @@ from timezones import timezones
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging.info(f"Imports finished in {time.perf_counter() - started_at:.3f}s")
+cold_start_reported = False
 
 db = Database("db.json")
 
@@ -25,10 +33,19 @@ intents = discord.Intents(messages=True, guilds=True, message_content=True, memb
 client = discord.Client(intents=intents)
 tree = app_commands.CommandTree(client)
 
-commands = json.load(open("commands.json", "r"))
-
 handler = DiscordHandler()
 
+#With WOPR-Workers set, the gateway only enqueues messages and a pool of worker processes runs the MessageHandler.
+workers = int(os.environ.get("WOPR-Workers", "0"))
+gateway = GatewayQueue(db, workers) if workers > 0 else None
+
+async def setup_hook():
+    personas.start()
+    metrics.serve_from_env()
+    if gateway is not None:
+        await gateway.start()
+client.setup_hook = setup_hook
+
 def split_into_chunks(text, chunk_size=2000):
     chunks = []
     while len(text) > chunk_size:
@@ -45,20 +62,27 @@ async def send(channel, text):
 async def complete(message:Message, database: Database, sendable: Sendable):
     await ConversationCompletionAction()(message, database, sendable)
 
-for command in commands:
-    def command_maker(system, user):
-        async def interaction(interaction):
-            await interaction.response.defer()
-            convo = Conversation.new_conversation()
-            convo.set_system("system", system)
-            db.set_conversation(interaction.user, convo)
-            db.set_current_conversation(interaction.user, convo)
-            sendable = DiscordSendable(interaction.followup)
-            message = Message.from_message(interaction.message)
-            await complete(message, db, sendable)
-        return interaction
-    tree.add_command(discord.app_commands.Command(name=command["command"], description=command["description"], callback=command_maker(command["system"], command["user"])))
+persona_cache = PersonaResponseCache.from_env()
+
+async def start_persona(interaction : discord.Interaction, persona : Persona):
+    await interaction.response.defer()
+    #The opener is shared by everyone who invokes the persona, so it's completed without any per-user context.
+    convo = persona.new_conversation()
+    convo.add_user(persona.user)
+    db.set_conversation(interaction.user, convo)
+    db.set_current_conversation(interaction.user, convo)
+    sendable = DiscordSendable(interaction.followup)
+    completion = persona_cache.get(persona)
+    if completion is not None:
+        await sendable.send(completion)
+    else:
+        completion = await chatgpt.pipe_completion(convo.get_conversation(), sendable, call_site="persona_opener")
+        persona_cache.add(persona, completion)
+    convo.add_assistant(completion)
+    db.set_conversation(interaction.user, convo)
 
+personas = PersonaRegistry(tree, start_persona)
+personas.load()
 
 @tree.command(name="summary", description="Get a summary of your conversations")
 async def summary_command(interaction):
@@ -94,14 +118,30 @@ def channel_responder(channel, chunk_size=60):
 
 @client.event
 async def on_ready():
+    global cold_start_reported
     logging.info('Logged in as {0.user}'.format(client))
-    await tree.sync()
+    await sync_if_changed(tree, personas.raw)
+    if not cold_start_reported:
+        cold_start_reported = True
+        logging.info(f"Cold start took {time.perf_counter() - started_at:.3f}s")
+
+@client.event
+async def on_typing(channel, user, when):
+    if user == client.user or user.bot:
+        return
+    #Warm the user's conversation, knowledge and tools so on_message doesn't wait on storage.
+    if gateway is not None:
+        await gateway.prefetch(user)
+    else:
+        await db.prefetch_async(user)
 
 @client.event
 async def on_message(message): 
     if message.author == client.user or message.author.bot:
         return
     async def handle_message_async(message):
+        if gateway is not None:
+            return await gateway.submit_discord_message(message, message.channel)
         return await handler.handle_discord_message(message, db, message.channel)
     asyncio.create_task(handle_message_async(message))
     
@@ -33,7 +33,7 @@ class ConversationCompletionAction(Action):
                 conversation.add_tool_call_result(tool_call_result)
         database.set_conversation(message.user, conversation)
         database.set_current_conversation(message.user, conversation)
-        completion = await chatgpt.pipe_completion(conversation.get_conversation(), sendable)
+        completion = await chatgpt.pipe_completion(conversation.get_conversation(), sendable, call_site="conversation_completion")
         conversation.add_assistant(completion)
         database.set_conversation(message.user, conversation)
 
@@ -60,7 +60,7 @@ class ConversationSummaryAction(Action):
                     compressed_conversation.append(msg)
                     count += len(str(msg))
             compressed_conversation.reverse()
-            conversation.messages = compressed_conversation
+            conversation.messages = MessageStore(compressed_conversation)
         database.set_conversation(message.user, conversation)
                 
 class ConversationChangeException(Exception):
@@ -104,6 +104,7 @@ class CreateToolButton(discord.ui.View): # Create a class called MyView that sub
     async def button_callback(self, interaction, button):
         await interaction.response.send_message("Creating the tool.")
         self.database.add_tool(interaction.user, self.tool_spec)
+        docker_runner.image_cache.prebuild(self.tool_spec.pip_packages)
     @discord.ui.button(label="Cancel", style=discord.ButtonStyle.danger)
     async def cancel_callback(self, interaction, button):
         await interaction.delete_original_response()
@@ -128,5 +129,6 @@ class UseToolAction(Action):
 
 from sendable import Sendable
 from db import Database
-from dto import Conversation, Message, ToolDefinition
+from dto import Conversation, Message, MessageStore, ToolDefinition
 import chatgpt
+import docker_runner
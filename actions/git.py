@@ -7,15 +7,14 @@ from dto import Message
 from intent_classifier import Sendable
 from db import Database
 from chatgpt import get_git_repo_and_options
-import os
-from subprocess import Popen, PIPE
+from git_executor import git_executor
 
 class GitCloneAction(Action):
     def __init__(self, repo : dict[str, str]):
         super().__init__("Git Clone Action", "Clone a git repository.")
         self.repo = repo
     async def __call__(self, message : Message, database : Database, sendable : Sendable) -> None:
-        result = do_command(self.repo)
+        result = await do_command(self.repo)
         if result:
             await sendable.send(result)
         else:
@@ -26,35 +25,19 @@ class GitCloneAction(Action):
             conversation.add_assistant("A git repository called " + self.repo["repo"] + " has been cloned from " + self.repo["url"] + " with the options: " + self.repo["options"])
             database.set_conversation(message.user, conversation)
 
-def invoke_at(path: str):
-    def parameterized(func):
-        def wrapper(*args, **kwargs):
-            os.makedirs(path, exist_ok=True)
-            cwd = os.getcwd()
-            os.chdir(path)
-
-            try:
-                ret = func(*args, **kwargs)
-            finally:
-                os.chdir(cwd)
-
-            return ret
-
-        return wrapper
-
-    return parameterized 
-
-@invoke_at("scratch/git")
-def do_command(command : dict[str, str]) -> str:
+async def do_command(command : dict[str, str]) -> str:
     if command["executable"] != "git":
         raise ValueError("Command is not a git command.")
-    command_str = f"git {command['command']} {command['url']} {command['options']}"
-    process = Popen(command_str, stdout=PIPE, stderr=PIPE, shell=True)
-    stdout, stderr = process.communicate()
-    if process.returncode!= 0:
-        return f"Failed to execute {command['command']}.\n{stderr.decode('utf-8')}"
+    if command["command"] != "clone":
+        return f"Unsupported git command: {command['command']}."
+    try:
+        result = await git_executor.clone(command["url"], command["repo"], command.get("options"))
+    except ValueError as e:
+        return f"Failed to execute {command['command']}.\n{e}"
+    if not result.ok:
+        return f"Failed to execute {command['command']}.\n{result.stderr}"
     else:
-        return stdout.decode('utf-8')
+        return result.stdout
 
 
-#do_command({"executable": "git", "command": "clone", "url": "https://github.com/tsavo/image-processor", "options": ""})
+#asyncio.run(do_command({"executable": "git", "command": "clone", "url": "https://github.com/tsavo/image-processor", "options": ""}))
@@ -1,10 +1,10 @@
 from __future__ import annotations
 import logging
 from typing import Any, List, Optional, Tuple, Type
-from openai import OpenAI, AsyncOpenAI
+from openai import AsyncOpenAI
 import os
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-from retry import retry
+import functools
+from lazy import lazy_import
 import yaml
 from typing import TypeVar
 import source_utils
@@ -12,47 +12,88 @@ from sendable import Sendable
 from dto import Function, FunctionParameter, FunctionParameters, MessageClassification, Tool, ToolDefinition
 import re
 import json
+import time
+import asyncio
+from llm_metrics import metrics
+from tracing import tracer
 
 
 T = TypeVar("T", bound=object)
 
-client = OpenAI(api_key=os.getenv("OpenAIAPI"))
 aclient = AsyncOpenAI(api_key=os.getenv("OpenAIAPI"))
 
 
-# Create an instance of the SentimentIntensityAnalyzer object
-analyzer = SentimentIntensityAnalyzer()
+vader = lazy_import("nltk.sentiment.vader")
+
+# Building the SentimentIntensityAnalyzer loads the vader lexicon, so only do it the first time it's needed
+@functools.cache
+def get_analyzer():
+    return vader.SentimentIntensityAnalyzer()
 
 exact_engine = "gpt-4"
 fast_engine="gpt-3.5-turbo"
 
-@retry(tries=3, delay=3, backoff=2, logger=logging.getLogger(__name__))
-async def get_completion(messages :list[dict[str,str]], model:str=exact_engine, temperature:float=0.5, exact=False, tools:List[ToolDefinition]=[]) -> str:
+async def get_completion(messages :list[dict[str,str]], model:str=exact_engine, temperature:float=0.5, exact=False, tools:List[ToolDefinition]=[], call_site:str="other") -> str:
+    #call_site names the helper making the call, so usage can be broken down by helper
     if exact:
         model=exact_engine
     request = {"model":model, "messages":messages, "temperature":temperature}
     if tools is not None and len(tools) > 0:
         request["tools"] = tools
-    response = client.chat.completions.create(**request)
-    if response is None:
-        raise Exception("No response from OpenAI")
+    start = time.perf_counter()
+    #Retried here rather than with @retry, which can't see exceptions raised by a coroutine
+    tries, delay = 3, 3
+    for attempt in range(tries):
+        try:
+            with tracer.span("llm.completion", model=model, call_site=call_site):
+                response = await aclient.chat.completions.create(**request)
+            if response is None:
+                raise Exception("No response from OpenAI")
+            break
+        except Exception as e:
+            if attempt == tries - 1:
+                metrics.increment("wopr_llm_errors_total", call_site, model)
+                raise
+            logging.warning(f"{call_site} completion failed, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay *= 2
+    usage = response.usage
+    metrics.record(call_site, model, time.perf_counter() - start, usage.prompt_tokens if usage else None, usage.completion_tokens if usage else None, retries=attempt)
     return response.choices[0].message.content, response.choices[0].message.tool_calls
 
-async def pipe_completion(messages : list[dict[str,str]], sendable: Sendable, model:str=exact_engine, tempeature:float=0.5, exact=True) -> str:
+async def pipe_completion(messages : list[dict[str,str]], sendable: Sendable, model:str=exact_engine, tempeature:float=0.5, exact=True, call_site:str="other") -> str:
     if not exact:
         model=fast_engine
     pipe, done = sendable.get_pipe()
     completion = ""
+    start = time.perf_counter()
+    ttft = None
+    usage = None
     
-    async for chunk in await aclient.chat.completions.create(model=model,
-    messages=messages,
-    stream=True):
-        content = json.loads(chunk.json())["choices"][0].get("delta", {}).get("content")
-        if content is not None and content != "":
-            await pipe(content)
-            completion += content
-        else:
-            await done()
+    with tracer.span("llm.stream", model=model, call_site=call_site):
+        try:
+            async for chunk in await aclient.chat.completions.create(model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}):
+                #With include_usage the last chunk has the usage and no choices
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if len(chunk.choices) == 0:
+                    continue
+                content = json.loads(chunk.json())["choices"][0].get("delta", {}).get("content")
+                if content is not None and content != "":
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                        tracer.tag(ttft_ms=round(ttft * 1000))
+                    await pipe(content)
+                    completion += content
+                else:
+                    await done()
+        except Exception:
+            metrics.increment("wopr_llm_errors_total", call_site, model)
+            raise
+    metrics.record(call_site, model, time.perf_counter() - start, usage.prompt_tokens if usage else None, usage.completion_tokens if usage else None, ttft=ttft)
     return completion
 
 def get_body(message : str) -> str:
@@ -72,7 +113,7 @@ async def extract_topic(message : str) -> str:
         {"role":"system","content":"You are a helpful AI assistant who knows how to extract a topic from a sentence for searching Wikipedia with. I will supply you with a sentence, and I want you to tell me, in quotes, a word or phrase suitible for searching Wikipedia with. Please supply only the singular thing to search in quotes. For example, if I say 'I want to search Wikipedia for the meaning of life', you should say 'meaning of life' and nothing else."},
         {"role":"user","content":"What is the topic being discussed here? \"" + message + "\" Please only supply the topic in quotes. Make sure to include the quotes and nothing else except the topic in quotes."}
     ]
-    result, tool_calls = await get_completion(convo)
+    result, tool_calls = await get_completion(convo, call_site="extract_topic")
     return result.replace('"', '').replace("'", "").rstrip().lstrip()
 
 async def summarize(conversation: str) -> str:
@@ -80,7 +121,7 @@ async def summarize(conversation: str) -> str:
         {"role":"system","content":"You are a helpful AI assistant who knows how to extract information from a conversational text for integration into a knowledge base, and return only the summarized content as a list without making reference to the request. Please summarize the entirety of the following text as a list of key factual and conversational datapoints from the conversation. Please supply as many important details in the summary as you can, including descriptions or summaries of all provided examples, and return only the bulleted list of datapoints. Include nothing but the list in your reply. Don't use words like \"summary\" or \"prior conversations\" in your reply unless they are part of the data in the list itself. Please remember to summarize ALL of the text, even if there are large spaces between words or paragraphs."},
         {"role":"user","content":"What is a highly detailed summary of this content? \"" + conversation[:3800] + "\" Please only supply the summary in quotes. Make sure to include the quotes and nothing else except the summary in quotes."}
     ]
-    result, tool_calls = await get_completion(convo)
+    result, tool_calls = await get_completion(convo, call_site="summarize")
     return result.replace('"', '').replace("'", "").rstrip().lstrip()
 
 async def summarize_data(data: str) -> str:
@@ -88,11 +129,11 @@ async def summarize_data(data: str) -> str:
         {"role":"system","content":"You are a helpful AI assistant who knows how to create detailed summaries of content. I will supply you with some content, and I want you to tell me, in quotes, a summary of the conversation. Please supply as many important details in the summary as you can."},
         {"role":"user","content":"What is a highly detailed summary of this content? \"" + data[:3800] + "\" Please only supply the summary in quotes. Make sure to include the quotes and nothing else except the summary in quotes."}
     ]
-    result, tool_calls = await get_completion(convo)
+    result, tool_calls = await get_completion(convo, call_site="summarize_data")
     return result.replace('"', '').replace("'", "").rstrip().lstrip()
 
 def is_positive(message : str) -> bool:
-    scores = analyzer.polarity_scores(message)
+    scores = get_analyzer().polarity_scores(message)
     return scores['compound'] > 0
 
 async def get_is_request_to_change_topics(context : str, user_input : str) -> bool:
@@ -101,7 +142,7 @@ async def get_is_request_to_change_topics(context : str, user_input : str) -> bo
         {"role":"system","content":"Previously I was talking about: " + context},
         {"role":"user","content":"Is this an explicit or obvious request to change topics? \"" + user_input + "\""}
     ]
-    result, tool_calls = await get_completion(convo)
+    result, tool_calls = await get_completion(convo, call_site="get_is_request_to_change_topics")
     result = result.replace('"', '').replace("'", "").rstrip().lstrip()
     return is_positive(result)
 
@@ -111,7 +152,7 @@ async def get_new_or_existing_conversation(old_conversations : str, user_input :
         {"role":"system","content":"Here are the prior conversations:\n" + old_conversations},
         {"role":"user","content":"Is this a new conversation or related to a prior conversation? \"" + user_input + "\" Please only supply the prior conversation in quotes, or say 'new conversation' if this is a new conversation. Make sure to include the specific conversation number. I need the number, not the topic. For example, if I say 'I want to know if this is a new conversation or related to a prior conversation. Please give me the related conversation number, or 'new conversation' if this is a new conversation. Remember, I really want the number of the conversation, like 3 or 5."}
     ]
-    result, tool_calls = await get_completion(convo)
+    result, tool_calls = await get_completion(convo, call_site="get_new_or_existing_conversation")
     result = result.replace('"', '').replace("'", "").rstrip().lstrip()
     if "new conversation" in result.lower() and re.search(r"\d+", result) is None:
         return -1
@@ -126,7 +167,7 @@ async def summarize_knowledge(conversation_summary: str) -> str:
         {"role":"system","content":"Here are the summaries of prior conversations:\n" + conversation_summary},
         {"role":"user","content":"What is the knowledge base of our prior conversations? Please write a paragraph or three containing the key datapoints from all the conversations. Make sure to include key datapoints from all the conversations."}
     ]
-    result, tool_calls = await get_completion(convo)
+    result, tool_calls = await get_completion(convo, call_site="summarize_knowledge")
     return result.replace('"', '').replace("'", "").rstrip().lstrip()
 
 async def find_similar_conversations(conversations : str) -> Optional[Tuple[int, int]]:
@@ -135,7 +176,7 @@ async def find_similar_conversations(conversations : str) -> Optional[Tuple[int,
         {"role":"system","content":"Here are the conversations in question:\n" + conversations},
         {"role":"user","content":"Is there any similar conversation that are discussing related topics? Please list the conversation by number, for example, 'Conversations 2 and 4 are simiar."}
     ]
-    result, tool_calls = await get_completion(convo)
+    result, tool_calls = await get_completion(convo, call_site="find_similar_conversations")
     result = result.replace('"', '').replace("'", "").rstrip().lstrip()
     #find 2 numbers
     numbers = re.findall(r"\d+", result)
@@ -151,7 +192,7 @@ async def merge_conversations(conversation1 : str, conversation2 : str) -> list[
         {"role":"user","content":"Conversation 2:\n```\n" + conversation2 + "\n```\n"},
         {"role":"user","content":"Please produce a new conversation that merges the two conversations into a single conversation."}
     ]
-    result, tool_calls = await get_completion(convo)
+    result, tool_calls = await get_completion(convo, call_site="merge_conversations")
     result = result.replace('"', '').replace("'", "").rstrip().lstrip()
     result = [ {"role":x[0].strip().lower(), "content":x[1].strip()} for x in [ x.split(":") for x in result.split("\n") if x.strip() != "" and ":" in x and ("assistant" in x.lower() or "user" in x.lower() or "system" in x.lower()) ] ]
     return result
@@ -161,7 +202,7 @@ async def extract_urls(query : str) -> List[dict[str,str]]:
         {"role":"system","content":"You are a helpful ai assistant who knows how to given a message, guess the url i should be querying, and make a good query for that specific url as to what I should search it for. You will take the message i give you, and you will tell me what url i should query, and what query I should search that url for given that message. Remember to take into account the nature of the website when answering the question."},
         {"role":"user","content":f"Your first example is, \"{query}\" What is the url of the company or brand mentioned there, or what urls might be relevant what is being discussed, ignoring any questions or statements that don't make sense, and what should i query them for specifically in quotes? I just want the url and the query, please dont mention what I should not search for or the reasoning. Do NOT put the url in quotes, as that will only confuse me. Format your response in yaml, with an array of NAME, URL and QUERY pairs."}         
     ]
-    result = (await get_completion(convo)).replace('"', '').replace("'", "").rstrip().lstrip()
+    result = (await get_completion(convo, call_site="extract_urls")).replace('"', '').replace("'", "").rstrip().lstrip()
     
     try:
         result = result.split("```")[1]
@@ -209,7 +250,7 @@ async def classify_intent(categories : List[str], query : str, context: Optional
     if context is not None:
         convo += [{"role": "user", "content": "For context: " + context}]
     convo += [{"role": "user", "content": f'Please classify this message as one or more of the above options listed:\n"{query}"'}]
-    result, tool_calls = await get_completion(convo, temperature=0, tools=tools)
+    result, tool_calls = await get_completion(convo, temperature=0, tools=tools, call_site="classify_intent")
     if result is None:
         return None, tool_calls
     try:
@@ -237,7 +278,7 @@ async def extract_preferences(message) -> dict[str,str]:
 ```"""},
         {"role":"user","content":"Please convert the following into a YAML map of preferences: " + message}
     ]
-    result = await get_completion(convo)
+    result = await get_completion(convo, call_site="extract_preferences")
     try:
         result = get_body(result)
         result = yaml.load(result, Loader=yaml.Loader)
@@ -251,7 +292,7 @@ async def remove_change_of_topic(message : str) -> str:
         {"role":"system", "content":"For example, if I say to you, \"Can we discuss Queen Elizabeth instead of talking about this? Did she die according to Wikipedia?\", you would reply with,\n```yaml\nDid Queen Elizabeth die accoring to Wikipedia?```\n and nothing else. If it doesnt mention a topic change just quote it directly as your reply. Output the new request as a YAML string."},
         {"role":"user", "content":"Please reformat this to not include the mention of change of topic: \"" + message + "\". Remember to output the result as a YAML string, and don't use words like \"instead\" in your reply."}
     ]
-    result = await get_completion(convo)
+    result = await get_completion(convo, call_site="remove_change_of_topic")
     try:
         return get_body(result)
     except:
@@ -271,7 +312,7 @@ options: --branch stable
 """},
         {"role":"user","content":"Please convert the following into a YAML map: " + message}
     ]
-    result = (await get_completion(convo))
+    result = (await get_completion(convo, call_site="get_git_repo_and_options"))
     try:
         result = result.split("```")[1]
         if result.lower().startswith("yaml"):
@@ -298,7 +339,7 @@ async def get_structured_classification(message: str, cls: Type[T], constraints:
         convo += [{"role": "system", "content": "Here's some additional context for the request. Be sure and include relevant information from here when additional information can be synthasized, for example relevant API keys or other secrets: " + additional_context}]
     convo += [{"role": "system", "content": "Be sure you escape any inner quotes in strings. Don't forget!!!"}]
     convo += [{"role": "user", "content": f'Be sure you escape any inner quotes in strings. Don\'t forget!!! Please convert the following into a blockquoted YAML dictionary or array of dictionaries that follows the above constraints: "{message}"\n'}]
-    result, tool_calls = await get_completion(convo, tools=tools)
+    result, tool_calls = await get_completion(convo, tools=tools, call_site="get_structured_classification")
     if result is None:
         return [], tool_calls
     result = get_body(result)
@@ -354,6 +395,8 @@ Based on this description, please provide the following:
 4. Any static parameters for the invocation such as api keys or other static parameters that are NOT part of the function signature. They MUST be part of the python function parameters, but MUST NOT be in the Tool definition.
 5. A unique and descriptive name and a highly descriptive type for the Tool (type on Tool), knowing that the names and types in the system need to be unique and highly descriptive of what they do. The name and the type should be the same and should be highly descriptive (good: "Specific Program Search Tool With API Key", bad: "QueryTool").
 6. A unit test, or example invocation, with all the parameters supplied hard coded, and an assertion that the output is correct. This is to ensure that the tool works as expected. The unit test should be a string, the example_invocation variable of the ToolDescription class.
+7. Whether the tool is cacheable: true only if calling it twice with the same arguments always gives the same output and has no side effects, otherwise false.
+8. Whether the tool needs network access: false only if the python never makes a network request, otherwise true.
 
 static_parameters MUST be in the Python function parameters but MUST NOT be in the Tool FunctionParameters. static_parameters MUST NOT be default parameters in the python. They are used to hold secrets like api keys and MUST be part of the python function signature and MUST be excluded from the Tool FunctionParameters.
 
@@ -364,7 +407,7 @@ Use the following @dataclass to represent your output, and blockquote it in YAML
 
 Do NOT discuss the solution. JUST output YAML for a ToolDescription object I can deserialize. You don't need to redefine the classes provided either. Do NOT include the Tool classes in the python. Just give me a serialized ToolDescription with the Tool, and the python for the tool implementation. Again, DO NOT repeat the tool and function and associated dataclasses in the output. Make sure the python is a string in the python variale of the ToolDescription class. Do NOT include class definitions or type hints in the YAML.
 '''}]
-    result, tool_calls = await get_completion(convo)
+    result, tool_calls = await get_completion(convo, call_site="get_tool_spec")
     result = get_body(result)
     result = source_utils.from_yaml(result, ToolDefinition)
     return result
\ No newline at end of file
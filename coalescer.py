@@ -0,0 +1,81 @@
+from __future__ import annotations
+import asyncio
+import dataclasses
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from dto import Message
+
+BurstKey = Tuple[str, Optional[str]]
+
+class Burst:
+    def __init__(self, args : Tuple[Any, ...]):
+        self.messages : List[Message] = []
+        self.args = args
+        self.arrived = asyncio.Event()
+        self.started = asyncio.get_running_loop().time()
+
+def merge_messages(messages : List[Message]) -> Message:
+    if len(messages) == 1:
+        return messages[0]
+    first = messages[0]
+    return dataclasses.replace(first,
+                               text="\n".join(message.text for message in messages),
+                               followup=first.followup + [str(message.discord_message_id) for message in messages[1:]])
+
+class MessageCoalescer:
+    #Merges messages a user sends in quick succession in one channel into a single Message. A burst is flushed
+    #after `window` seconds without a new message, or `max_wait` seconds after it started.
+    def __init__(self, handle : Callable[..., Awaitable[None]], window : float = 1.0, max_wait : float = 4.0):
+        self.handle = handle
+        self.window = window
+        self.max_wait = max_wait
+        self.bursts : Dict[BurstKey, Burst] = {}
+        self.locks : Dict[BurstKey, asyncio.Lock] = {}
+
+    @staticmethod
+    def from_env(handle : Callable[..., Awaitable[None]]) -> MessageCoalescer:
+        return MessageCoalescer(handle, float(os.environ.get("WOPR-Coalesce-Window", "1.0")), float(os.environ.get("WOPR-Coalesce-Max-Wait", "4.0")))
+
+    def key(self, message : Message) -> BurstKey:
+        return (str(message.user.id), message.channel.id if message.channel is not None else None)
+
+    async def submit(self, message : Message, *args : Any) -> None:
+        if self.window <= 0:
+            return await self.handle(message, *args)
+        key = self.key(message)
+        burst = self.bursts.get(key)
+        if burst is not None:
+            burst.messages.append(message)
+            burst.arrived.set()
+            return
+        burst = Burst(args)
+        burst.messages.append(message)
+        self.bursts[key] = burst
+        await self.run(key, burst)
+
+    async def wait_for_quiet(self, burst : Burst) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            remaining = self.max_wait - (loop.time() - burst.started)
+            if remaining <= 0:
+                return
+            burst.arrived.clear()
+            try:
+                await asyncio.wait_for(burst.arrived.wait(), min(self.window, remaining))
+            except asyncio.TimeoutError:
+                return
+
+    async def run(self, key : BurstKey, burst : Burst) -> None:
+        await self.wait_for_quiet(burst)
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                #Until now late arrivals could still join this burst; from here on they start the next one.
+                del self.bursts[key]
+                if len(burst.messages) > 1:
+                    logging.info(f"Coalesced {len(burst.messages)} messages from {key[0]} into one turn")
+                await self.handle(merge_messages(burst.messages), *burst.args)
+        finally:
+            if key not in self.bursts and not lock.locked():
+                self.locks.pop(key, None)
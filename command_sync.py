@@ -0,0 +1,35 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, List
+from discord import app_commands
+
+def describe_command(command : Any) -> dict[str, Any]:
+    description = {"name": command.name, "description": command.description, "type": type(command).__name__}
+    if isinstance(command, app_commands.Group):
+        description["commands"] = [describe_command(child) for child in command.commands]
+    elif isinstance(command, app_commands.Command):
+        description["parameters"] = [{"name": p.name, "description": p.description, "type": str(p.type), "required": p.required} for p in command.parameters]
+    return description
+
+def get_command_tree_hash(tree : app_commands.CommandTree, commands : List[dict[str, str]]) -> str:
+    registry = sorted((describe_command(command) for command in tree.get_commands()), key=lambda x: x["name"])
+    payload = json.dumps({"commands.json": commands, "registry": registry}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def sync_if_changed(tree : app_commands.CommandTree, commands : List[dict[str, str]], hash_path : str = ".command_tree_hash") -> bool:
+    #Global syncs are heavily rate limited, so only sync when commands.json or the built in commands actually changed.
+    current = get_command_tree_hash(tree, commands)
+    previous = None
+    if os.path.exists(hash_path):
+        with open(hash_path, "r") as file:
+            previous = file.read().strip()
+    if previous == current and os.environ.get("WOPR-Force-Sync") is None:
+        logging.info(f"Command tree unchanged ({current[:12]}), skipping sync")
+        return False
+    await tree.sync()
+    with open(hash_path, "w") as file:
+        file.write(current)
+    logging.info(f"Synced command tree ({current[:12]})")
+    return True
@@ -3,7 +3,12 @@ from chatgpt import send_to_ChatGPT, async_send_to_ChatGPT
 from chatgpt import extract_topic, summarize
 import wikipedia
 from typing import Optional, Callable, List, Dict, Any
+import asyncio
 import datetime
+import inspect
+import logging
+import os
+import time
 import jsonpickle
 from uuid import uuid4
 
@@ -22,19 +27,60 @@ def get_wiki_suggestion(topic : str) -> str:
             except wikipedia.exceptions.DisambiguationError:
                 continue
         return summary    
+
+class TTLCache:
+    def __init__(self, ttl : float, maxsize : int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries : Dict[Any, Any] = {}
+    def get(self, key : Any, loader : Callable[[], Any]) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        value = loader()
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic(), value)
+        while len(self.entries) > self.maxsize:
+            del self.entries[next(iter(self.entries))]
+        return value
+
+wiki_cache = TTLCache(ttl=3600)
+
+class ContextSlot:
+    #Context a Mode puts in front of the model. The loader runs when the conversation is rendered, at most every
+    #`ttl` seconds.
+    def __init__(self, loader : Callable[[], str], ttl : float = 0):
+        self.loader = loader
+        self.ttl = ttl
+        self.value : Optional[str] = None
+        self.loaded_at : Optional[float] = None
+    def render(self) -> str:
+        if self.loaded_at is None or time.monotonic() - self.loaded_at >= self.ttl:
+            self.value = self.loader()
+            self.loaded_at = time.monotonic()
+        return self.value
+
 class Mode:
+    #Modes that only enrich the conversation's context leave the message alone, so CompoundMode can run them concurrently.
+    transforms = True
     def __init__(self, name : str, user : int = -1, conversation_manager : Optional["ConversationManager"] = None):
         self.name = name
         self.user = user
         self.conversation_manager = conversation_manager
     def __call__(self, _ : str) -> str:
         raise NotImplementedError(f"{type(self)} does not implement __call__.")
+    async def acall(self, message : str) -> str:
+        return self(message)
+    def clear_context(self) -> None:
+        if self.conversation_manager is not None:
+            self.conversation_manager.get_current_conversation(self.user).clear_context(self.name)
 class DefaultMode(Mode):
     def __init__(self):
         super().__init__("Default Mode")
     def __call__(self, message : str) -> str:
         return message
 class WikipediaMode(Mode):
+    transforms = False
     def __init__(self, user : int, conversation_manager : Optional["ConversationManager"] = None):
         if conversation_manager is None:
             raise ValueError("Wikipedia Mode requires a conversation_manager.")
@@ -43,61 +89,104 @@ class WikipediaMode(Mode):
         if self.conversation_manager is None:
             raise ValueError("Wikipedia Mode requires a conversation_manager.")
         topic = extract_topic(message)
-        summary = get_wiki_suggestion(topic)
-        self.conversation_manager.get_current_conversation(self.user).add_system("As a point of reference Wikipedia says the following about " + topic + " (may be off topic):\n" +  summary)
+        self.conversation_manager.get_current_conversation(self.user).set_context(self.name, lambda: "As a point of reference Wikipedia says the following about " + topic + " (may be off topic):\n" + wiki_cache.get(topic, lambda: get_wiki_suggestion(topic)))
+        return message
+    async def acall(self, message : str) -> str:
+        if self.conversation_manager is None:
+            raise ValueError("Wikipedia Mode requires a conversation_manager.")
+        topic = await extract_topic(message)
+        summary = await asyncio.to_thread(wiki_cache.get, topic, lambda: get_wiki_suggestion(topic))
+        self.conversation_manager.get_current_conversation(self.user).set_context(self.name, lambda: "As a point of reference Wikipedia says the following about " + topic + " (may be off topic):\n" + summary)
         return message
 
 class MeanMode(Mode):
+    transforms = False
     def __init__(self, user : int, conversation_manager : Optional["ConversationManager"] = None):
         super().__init__("Mean Mode", user, conversation_manager)
     def __call__(self, message : str) -> str:
         if self.conversation_manager is None:
             raise ValueError("Mean Mode requires a conversation_manager.")
-        self.conversation_manager.get_current_conversation(self.user).add_system("Remember to be extra rude, insulting, and mean in your responses.")
+        self.conversation_manager.get_current_conversation(self.user).set_context(self.name, lambda: "Remember to be extra rude, insulting, and mean in your responses.")
         return message
 
 import pytz
 class DateTimeAwareMode(Mode):
+    transforms = False
     def __init__(self, user : int, conversation_manager : Optional["ConversationManager"] = None, timezone : str = "America/Los_Angeles"):
         super().__init__("DateTime Aware Mode", user, conversation_manager)
         self.timezone = timezone
+    def get_datetime(self) -> str:
+        formatted_time = datetime.datetime.now(pytz.timezone(self.timezone)).strftime("%m/%d/%Y, %I:%M:%S %p")
+        return "The current date and time is now " + formatted_time + "."
     def __call__(self, message : str) -> str:
         if self.conversation_manager is None:
             raise ValueError("DateTime Aware Mode requires a conversation_manager.")
-        formatted_time = datetime.datetime.now(pytz.timezone(self.timezone)).strftime("%m/%d/%Y, %I:%M:%S %p")
-        self.conversation_manager.get_current_conversation(self.user).add_system("The current date and time is now " + formatted_time + ".")
+        self.conversation_manager.get_current_conversation(self.user).set_context(self.name, self.get_datetime)
         return message
 
 class UserPreferenceAwareMode(Mode):
+    transforms = False
     def __init__(self, user : int, conversation_manager : Optional["ConversationManager"] = None, param_loader : lambda : dict = lambda : {}):
         super().__init__("User Preference Aware Mode", user, conversation_manager)
         self.param_loader = param_loader
-    def __call__(self, message : str) -> str:
-        if self.conversation_manager is None:
-            raise ValueError("User Preference Aware Mode requires a conversation_manager.")
+    def get_preferences(self) -> str:
         preferences = "Remember the following details in this conversation:\n"
         for key, value in self.param_loader().items():
             preferences += key + ": " + value + "\n"
-        self.conversation_manager.get_current_conversation(self.user).add_system(preferences) 
+        return preferences
+    def __call__(self, message : str) -> str:
+        if self.conversation_manager is None:
+            raise ValueError("User Preference Aware Mode requires a conversation_manager.")
+        self.conversation_manager.get_current_conversation(self.user).set_context(self.name, self.get_preferences)
         return message
 
 class KnowledgeAwareMode(Mode):
+    transforms = False
     def __init__(self, user : int, conversation_manager : Optional["ConversationManager"] = None, knowledge_loader : lambda : str = lambda : ""):
         super().__init__("Knowledge Aware Mode", user, conversation_manager)
         self.knowledge_loader = knowledge_loader
     def __call__(self, message : str) -> str:
         if self.conversation_manager is None:
             raise ValueError("Knowledge Aware Mode requires a conversation_manager.")
-        self.conversation_manager.get_current_conversation(self.user).add_system("Here's some things you should be aware of:\n" + self.knowledge_loader())
+        self.conversation_manager.get_current_conversation(self.user).set_context(self.name, lambda: "Here's some things you should be aware of:\n" + self.knowledge_loader())
         return message
 class CompoundMode(Mode):
-    def __init__(self, *modes : Union[Mode, Callable]):
+    #WikipediaMode waits on a GPT-4 completion to pick its topic, which usually takes a few seconds.
+    def __init__(self, *modes : Union[Mode, Callable], deadline : Optional[float] = None):
         super().__init__("Compound Mode")
         self.modes = modes
+        self.deadline = deadline if deadline is not None else float(os.environ.get("WOPR-Mode-Deadline", "10"))
     def __call__(self, message : str) -> str:
         for mode in self.modes:
             message = mode(message)
         return message
+    async def acall(self, message : str) -> str:
+        #Modes that rewrite the message run in order, then the enrichment modes all run at once. Any enrichment that
+        #misses the deadline is cancelled and skipped for this turn rather than holding up the reply, and its context
+        #from an earlier turn is cleared so the model doesn't get it for this message.
+        enrichers = []
+        for mode in self.modes:
+            if isinstance(mode, Mode) and not mode.transforms:
+                enrichers.append(mode)
+            elif isinstance(mode, Mode):
+                message = await mode.acall(message)
+            else:
+                message = mode(message)
+                if inspect.isawaitable(message):
+                    message = await message
+        if len(enrichers) == 0:
+            return message
+        tasks = {asyncio.create_task(mode.acall(message)): mode for mode in enrichers}
+        done, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        for task in pending:
+            task.cancel()
+            tasks[task].clear_context()
+            logging.warning(f"{tasks[task].name} missed the {self.deadline}s deadline and was skipped")
+        for task in done:
+            if task.exception() is not None:
+                tasks[task].clear_context()
+                logging.warning(f"{tasks[task].name} failed: {task.exception()}")
+        return message
 
 class Conversation:
     def __init__(self, user : int, system : str="You are a helpful AI assistant.", assistant : str="", modes : Union[List[Mode], List[Callable]] = []):
@@ -108,18 +197,32 @@ class Conversation:
         if assistant != "":
             self.messages.append({"role":"assistant","content":assistant})
         self.modes = modes
+        self.context : Dict[str, ContextSlot] = {}
         self.summary = "A conversation with a user that has not been summarized."
         self.id = str(uuid4())
     def add_user(self, user : str) -> None:
         for mode in self.modes:
             user = mode(user)
         self.messages.append({"role":"user","content":user})
+    async def async_add_user(self, user : str, deadline : Optional[float] = None) -> None:
+        user = await CompoundMode(*self.modes, deadline=deadline).acall(user)
+        self.messages.append({"role":"user","content":user})
     def add_system(self, system : str) -> None:
         self.messages.append({"role":"system","content":system})
+    def set_context(self, name : str, loader : Callable[[], str], ttl : float = 0) -> None:
+        self.context[name] = ContextSlot(loader, ttl)
+    def clear_context(self, name : str) -> None:
+        self.context.pop(name, None)
     def add_assistant(self, assistant : str) -> None:
         self.messages.append({"role":"assistant","content":assistant})
     def get_conversation(self):
-        return self.messages
+        if len(self.context) == 0:
+            return self.messages
+        #Context goes right before the user message it was computed for, like add_system used to put it.
+        context = [{"role":"system","content":slot.render()} for slot in self.context.values()]
+        if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
+            return self.messages[:-1] + context + self.messages[-1:]
+        return self.messages + context
     def get_user(self):
         return self.user
     def get_system(self):
@@ -186,7 +289,7 @@ class ConversationManager:
     async def async_update_conversation(self, user : int, user_input : str, pipe, done, conversation : Optional[Conversation] = None):
         if conversation is None:
             conversation = self.get_current_conversation(user)
-        conversation.add_user(user_input)
+        await conversation.async_add_user(user_input)
         pipe2, done2 = conversation_responder(conversation, pipe, done)
         await async_send_to_ChatGPT(conversation.get_conversation(), pipe2, done2)
     def add_conversation(self, conversation : Conversation) -> Conversation:
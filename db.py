@@ -1,15 +1,26 @@
 from __future__ import annotations
+import asyncio
+import copy
+import fcntl
+import functools
+import logging
+import os
+import threading
+import time
+from uuid import uuid4
+import weakref
 import discord
 from tinydb import TinyDB, Query
 from tinydb.queries import QueryInstance
-from typing import List, Optional, Type, Any, Union
+from tinydb.table import Table
+from typing import Callable, List, Optional, Type, Any, Union
 import jsonpickle
 from tinydb_serialization import Serializer
 from tinydb_serialization import SerializationMiddleware
 from tinydb.storages import JSONStorage
-from dto import Conversation, Knowledge, Tool
+from dto import ChatMessage, Conversation, Knowledge, MessageNode, MessageStore, Tool
 from dto import User, UserConversation
-from external_datasource import DataSource
+from tracing import tracer
 
 UserUnion = Union[User, discord.User]
 class JSONSerializer(Serializer):
@@ -30,27 +41,133 @@ def get_conversation_query(user: UserUnion, conversation_id : str, query = Query
     user_query = get_user_query(user, query)
     return user_query and query.conversation_id == conversation_id
     
+def locked(func):
+    #TinyDB reads and rewrites the whole file on every operation, so gateway and worker processes sharing db.json must not interleave.
+    #flock is held per open file, so threads of one process (prefetches) are kept apart by the thread lock.
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        #The span covers waiting for the lock too, which is where contention between processes shows up.
+        with tracer.span("db." + func.__name__, root=False), self.thread_lock:
+            if self.lock_depth > 0:
+                return func(self, *args, **kwargs)
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.lock_depth -= 1
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+    return wrapper
+
+class SharedTable(Table):
+    #Table remembers the next document id after its first insert, but another process may have inserted since, and
+    #reusing an id overwrites that document. Work it out from the file on every insert; inserts hold the file lock.
+    def insert(self, document):
+        self._next_id = None
+        return super().insert(document)
+    def insert_multiple(self, documents):
+        self._next_id = None
+        return super().insert_multiple(documents)
+
+class SharedTinyDB(TinyDB):
+    table_class = SharedTable
+
+class MessageTable(Table):
+    #Nodes are keyed by their own id instead of a counter, so rows don't repeat it and inserts never need the next id.
+    document_id_class = str
+    def insert_nodes(self, rows : dict[str, dict]) -> None:
+        #Another process may have written some of the same nodes; they're identical, so keep whichever is there.
+        def updater(table):
+            for node_id, row in rows.items():
+                table.setdefault(node_id, row)
+        self._update_table(updater)
+
+PRUNE_LOG_LIMIT = 1024 * 1024
+
+PREFETCHERS = {}
+
+def prefetchable(func):
+    #Serve reads from state loaded by Database.prefetch (e.g. while the user is typing) until it expires or is written to.
+    PREFETCHERS[func.__name__] = func
+    @functools.wraps(func)
+    def wrapper(self, user, *args, **kwargs):
+        entry = self.prefetched.get(str(user.id))
+        if len(args) == 0 and len(kwargs) == 0 and entry is not None and func.__name__ in entry["values"]:
+            if time.monotonic() < entry["expires"]:
+                value, cost = entry["values"][func.__name__]
+                self.prefetch_stats["hits"] += 1
+                self.prefetch_stats["saved"] += cost
+                return copy.deepcopy(value)
+            #Only a prefetch that expired or was written over before it was used is a miss.
+            self.prefetch_stats["misses"] += 1
+            entry["values"].pop(func.__name__, None)
+            if len(entry["values"]) == 0:
+                self.prefetched.pop(str(user.id), None)
+        return func(self, user, *args, **kwargs)
+    return wrapper
+
+def invalidates(func):
+    #After the write, so a prefetch that read the old state in the meantime is thrown away rather than kept.
+    @functools.wraps(func)
+    def wrapper(self, user, *args, **kwargs):
+        try:
+            return func(self, user, *args, **kwargs)
+        finally:
+            self.invalidate(str(user.id))
+            for listener in self.invalidation_listeners:
+                listener(str(user.id))
+    return wrapper
+
 class Database:
-    def __init__(self, db_path="db.json"):
+    def __init__(self, db_path="db.json", prefetch_ttl : float = 15):
+        self.db_path = db_path
+        self.prefetched = {}
+        self.prefetch_ttl = prefetch_ttl
+        self.prefetching = set()
+        #Bumped by invalidate, so a prefetch running in a thread knows if what it read was written over.
+        self.invalidations : dict[str, int] = {}
+        self.prefetch_stats = {"prefetches": 0, "hits": 0, "misses": 0, "saved": 0.0}
+        #Called with the user id on every write, so other processes holding prefetched state for the user can drop it.
+        self.invalidation_listeners : List[Callable[[str], None]] = []
+        self.lock_file = open(db_path + ".lock", "a")
+        self.thread_lock = threading.RLock()
+        self.lock_depth = 0
         middleware = SerializationMiddleware(JSONStorage)
         middleware.register_serializer(JSONSerializer(), "jsonpickle")
-        self.db = TinyDB(db_path, indent=4, separators=(',', ': '), ensure_ascii=False, storage=middleware) 
-        self.knowledge = self.db.table("knowledge")
-        self.conversations = self.db.table("conversations")
-        self.current_conversation = self.db.table("current_conversation")
-        self.knowledge = self.db.table("knowledge")
-        self.datasources = self.db.table("datasources")
-        self.tools = self.db.table("tools")
+        self.db = SharedTinyDB(db_path, indent=4, separators=(',', ': '), ensure_ascii=False, storage=middleware) 
+        #TinyDB's query cache is per Table object and only cleared by writes through it, so with another process
+        #writing the same file (gateway and workers) a cached result can be stale. The file is re-read on every query anyway.
+        self.knowledge = self.db.table("knowledge", cache_size=0)
+        self.conversations = self.db.table("conversations", cache_size=0)
+        self.current_conversation = self.db.table("current_conversation", cache_size=0)
+        self.datasources = self.db.table("datasources", cache_size=0)
+        self.tools = self.db.table("tools", cache_size=0)
+        #Message nodes are plain JSON, so they go in their own file, without the serializer jsonpickling every field.
+        self.message_db = TinyDB(db_path + ".messages", storage=JSONStorage)
+        self.messages = MessageTable(self.message_db.storage, "messages", cache_size=0)
+        self.message_nodes = weakref.WeakValueDictionary()
+        self.persisted_message_ids = set()
+        #Head each conversation had when this process last loaded or saved it, to notice when a save re-roots it.
+        self.conversation_heads : dict[str, str] = {}
+        #prune_messages appends the ids it removes, so other processes can forget them without re-reading the table.
+        self.prune_log = db_path + ".pruned"
+        self.prune_log_stat = self.get_prune_log_stat()
+        self.prune_log_position = self.get_prune_log_end()
 
+    @prefetchable
+    @locked
     def get_knowledge_base(self, user : UserUnion) -> dict[str, Knowledge]:
         if not self.knowledge.contains(get_user_query(user)):
             return {}
         else:
             return self.knowledge.search(get_user_query(user))[0].get("knowledge", {})
         
+    @locked
     def get_knowledge(self, user: UserUnion, knowledge_key, default=None) -> Optional[Knowledge]:
         return self.get_knowledge(user.id).get(knowledge_key, default)
     
+    @invalidates
+    @locked
     def set_knowledge(self, user : UserUnion, knowledge_key: str, knowledge_value: Knowledge):
         if not self.knowledge.contains(get_user_query(user)):
             self.knowledge.insert({"user_id": str(user.id), "knowledge": {knowledge_key: knowledge_value}})
@@ -59,6 +176,8 @@ class Database:
             knowledge[knowledge_key] = knowledge_value
             self.knowledge.upsert({"knowledge": knowledge}, get_user_query(user))
 
+    @invalidates
+    @locked
     def delete_knowledge(self, user : UserUnion, knowledge_key: str):
         if not self.knowledge.contains(get_user_query(user)):
             return
@@ -68,24 +187,46 @@ class Database:
             self.knowledge.upsert({"knowledge": knowledge}, get_user_query(user))
 
 
+    @locked
     def get_conversations(self, user : UserUnion) -> List[Conversation]:
         result = self.conversations.search(get_user_query(user))
-        return [r.get("conversation", None) for r in result]
+        return self.resolve_messages([r.get("conversation", None) for r in result])
     
+    @locked
     def get_conversation(self, user : UserUnion, conversation_id : str) -> Optional[Conversation]:
         result = self.conversations.get(get_conversation_query(user, conversation_id))
         if result is None:
             return None
-        return result.get("conversation", None)    
+        return self.resolve_messages([result.get("conversation", None)])[0]
+    @invalidates
+    @locked
     def set_conversation(self, user: UserUnion, conversation : Conversation):
+        self.save_messages(conversation.store)
         self.conversations.upsert(UserConversation(user_id=str(user.id), conversation=conversation, conversation_id=conversation.id).__dict__, get_conversation_query(user, conversation.id))
+        previous = self.conversation_heads.get(conversation.id)
+        head = conversation.store.head
+        if head is not None:
+            self.conversation_heads[conversation.id] = head.id
+        #Summaries replace the history with a new chain, which orphans the old one.
+        if previous is not None and not conversation.store.descends_from(previous):
+            self.prune_messages()
 
+    @invalidates
+    @locked
     def delete_conversation(self, user: UserUnion, conversation_id : str):
-        return self.conversations.remove(get_conversation_query(user, conversation_id))
+        removed = self.conversations.remove(get_conversation_query(user, conversation_id))
+        self.conversation_heads.pop(conversation_id, None)
+        if len(removed) > 0:
+            self.prune_messages()
+        return removed
 
+    @invalidates
+    @locked
     def set_current_conversation(self, user: UserUnion, conversation : Conversation):
         self.current_conversation.upsert({"user_id":str(user.id), "conversation_id": conversation.id}, get_user_query(user))
 
+    @prefetchable
+    @locked
     def get_current_conversation(self, user : UserUnion) -> Optional[Conversation]:
         if not self.current_conversation.contains(get_user_query(user)):
             return None
@@ -94,6 +235,8 @@ class Database:
             return None
         return self.get_conversation(user, conversation_id)
         
+    @invalidates
+    @locked
     def add_tool(self, user : UserUnion, tool : Tool):
         if not self.tools.contains(get_user_query(user)):
             self.tools.insert({"user_id":str(user.id), "tools": []})
@@ -101,6 +244,8 @@ class Database:
         tools.append(tool)
         self.tools.update({"tools": tools}, get_user_query(user))
     
+    @invalidates
+    @locked
     def remove_tool(self, user : UserUnion, tool : str):
         if not self.tools.contains(get_user_query(user)):
             return
@@ -108,7 +253,170 @@ class Database:
         tools.remove(tool)
         self.tools.update({"tools": tools}, get_user_query(user))
     
+    @prefetchable
+    @locked
     def get_tools(self, user : UserUnion) -> List[str]:
         if not self.tools.contains(get_user_query(user)):
             return []
-        return self.tools.search(get_user_query(user))[0].get("tools", [])
\ No newline at end of file
+        return self.tools.search(get_user_query(user))[0].get("tools", [])
+
+    def resolve_messages(self, conversations : List[Optional[Conversation]]) -> List[Optional[Conversation]]:
+        #The message table is read at most once however many conversations need nodes that aren't loaded.
+        rows = None
+        def load(node_id):
+            nonlocal rows
+            if rows is None and node_id not in self.message_nodes:
+                rows = {row.doc_id: row for row in self.messages.all()}
+            return self.load_message_node(node_id, rows)
+        for conversation in conversations:
+            if conversation is not None:
+                conversation.store.resolve(load)
+                if conversation.store.head is not None:
+                    self.conversation_heads[conversation.id] = conversation.store.head.id
+        return conversations
+
+    def get_prune_log_stat(self) -> Optional[tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.prune_log)
+            return stat.st_ino, stat.st_size, stat.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def get_prune_log_end(self) -> tuple[Optional[str], int]:
+        #The first line is a generation, new each time the log is started again.
+        try:
+            with open(self.prune_log) as log:
+                generation = log.readline().strip()
+                return generation, log.seek(0, os.SEEK_END)
+        except FileNotFoundError:
+            return None, 0
+
+    def forget_pruned_messages(self):
+        stat = self.get_prune_log_stat()
+        if stat == self.prune_log_stat:
+            return
+        generation, offset = self.prune_log_position
+        current, end = self.get_prune_log_end()
+        if current is not None and current == generation:
+            with open(self.prune_log) as log:
+                log.seek(offset)
+                self.persisted_message_ids.difference_update(log.read(end - offset).split())
+        else:
+            #The log was started again, perhaps before this process read the end of the old one.
+            self.persisted_message_ids &= {row.doc_id for row in self.messages.all()}
+        self.prune_log_stat = stat
+        self.prune_log_position = (current, end)
+
+    def save_messages(self, store : MessageStore):
+        #Nodes are content addressed and shared between forks, so only the ones this process hasn't written need saving.
+        self.forget_pruned_messages()
+        new_nodes = []
+        node = store.head
+        while node is not None and node.id not in self.persisted_message_ids:
+            new_nodes.append(node)
+            node = node.parent
+        if len(new_nodes) == 0:
+            return
+        self.messages.insert_nodes({n.id: self.get_message_row(n) for n in reversed(new_nodes)})
+        for n in new_nodes:
+            self.persisted_message_ids.add(n.id)
+            self.message_nodes[n.id] = n
+
+    def get_message_row(self, node : MessageNode) -> dict[str, Optional[str]]:
+        row = {"parent": node.parent.id if node.parent is not None else None, "role": node.role_name, "content": node.content}
+        if node.name is not None:
+            row["name"] = node.name
+        return row
+
+    def load_message_node(self, node_id : Optional[str], rows : Optional[dict[str, dict]]) -> Optional[MessageNode]:
+        if node_id is None:
+            return None
+        if node_id in self.message_nodes:
+            return self.message_nodes[node_id]
+        #Follow parents until a node that's already loaded (or the root), then build the chain back down from there.
+        chain = []
+        current = node_id
+        while current is not None and current not in self.message_nodes:
+            if rows is None or current not in rows:
+                raise KeyError("Message node " + current + " is missing")
+            chain.append(rows[current])
+            current = rows[current]["parent"]
+        node = self.message_nodes[current] if current is not None else None
+        for row in reversed(chain):
+            node = MessageNode(ChatMessage(row["role"], row["content"], row.get("name")), node, bytes.fromhex(row.doc_id))
+            self.message_nodes[row.doc_id] = node
+            self.persisted_message_ids.add(row.doc_id)
+        return node
+
+    @locked
+    def prune_messages(self) -> int:
+        reachable = set()
+        parents = {row.doc_id: row["parent"] for row in self.messages.all()}
+        for conversation in self.conversations.all():
+            store = conversation.get("conversation").messages
+            current = store.head.id if isinstance(store, MessageStore) and store.head is not None else getattr(store, "head_id", None)
+            #Stores saved with inline messages have nodes that were never written.
+            while current is not None and current in parents and current not in reachable:
+                reachable.add(current)
+                current = parents[current]
+        removed = self.messages.remove(doc_ids=[node_id for node_id in parents if node_id not in reachable])
+        if len(removed) > 0:
+            lines = "".join(node_id + "\n" for node_id in removed)
+            stat = self.get_prune_log_stat()
+            if stat is None or stat[1] > PRUNE_LOG_LIMIT:
+                #Start again under a new generation rather than grow for ever.
+                with open(self.prune_log + ".tmp", "w") as log:
+                    log.write(uuid4().hex + "\n" + lines)
+                os.replace(self.prune_log + ".tmp", self.prune_log)
+            else:
+                with open(self.prune_log, "a") as log:
+                    log.write(lines)
+            self.persisted_message_ids &= reachable
+            self.prune_log_stat = self.get_prune_log_stat()
+            self.prune_log_position = self.get_prune_log_end()
+            logging.info(f"Pruned {len(removed)} unreachable message nodes")
+        return len(removed)
+
+    def invalidate(self, user_id : str):
+        self.invalidations[user_id] = self.invalidations.get(user_id, 0) + 1
+        #Kept but expired, so the next read counts it as a miss.
+        entry = self.prefetched.get(user_id)
+        if entry is not None:
+            entry["expires"] = 0
+
+    def is_prefetched(self, user_id : str) -> bool:
+        entry = self.prefetched.get(user_id)
+        return entry is not None and time.monotonic() < entry["expires"]
+
+    def prefetch(self, user : UserUnion):
+        user_id = str(user.id)
+        invalidations = self.invalidations.get(user_id, 0)
+        values = {}
+        for name, fetch in PREFETCHERS.items():
+            start = time.perf_counter()
+            value = fetch(self, user)
+            values[name] = (value, time.perf_counter() - start)
+        if self.invalidations.get(user_id, 0) != invalidations:
+            return
+        self.prefetched[user_id] = {"expires": time.monotonic() + self.prefetch_ttl, "values": values}
+        self.prefetch_stats["prefetches"] += 1
+        if self.prefetch_stats["prefetches"] % 100 == 0:
+            logging.info("Prefetch stats: " + self.get_prefetch_summary())
+
+    async def prefetch_async(self, user : UserUnion):
+        #Typing events repeat every few seconds, and one prefetch lasts the TTL. The reads block, so they run in a
+        #thread to keep the event loop dispatching.
+        user_id = str(user.id)
+        if user_id in self.prefetching or self.is_prefetched(user_id):
+            return
+        self.prefetching.add(user_id)
+        try:
+            await asyncio.to_thread(self.prefetch, user)
+        finally:
+            self.prefetching.discard(user_id)
+
+    def get_prefetch_summary(self) -> str:
+        stats = self.prefetch_stats
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups if lookups > 0 else 0
+        return f"{stats['prefetches']} prefetches, {hit_rate:.1%} hit rate over {lookups} lookups, {stats['saved'] * 1000:.1f}ms saved"
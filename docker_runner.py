@@ -1,46 +1,349 @@
-from io import BytesIO, StringIO
-import docker
-import tempfile
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from io import BytesIO
+import logging
+import math
+from lazy import lazy_import
+import tarfile
+import time
 import os
+from typing import Callable, Dict, List, Optional, Set
+from dto import ToolDefinition
+from tool_executor import OutputCallback, OutputCapture, ScriptResult, ToolExecutor, register_executor
+from uuid import uuid4
 
-async def run_python_script(python_code, dependencies=[]):
-    # Create a temporary directory to hold the Python script
-    with tempfile.TemporaryDirectory() as temp_dir:
-        script_path = os.path.join(temp_dir, "script.py")
+docker = lazy_import("docker")
 
-        # Write the Python code to a script file
-        with open(script_path, 'w') as file:
-            file.write(python_code)
+BASE_IMAGE = "python:3.12-slim"
+IMAGE_REPOSITORY = "python_script_runner"
+IMAGE_LABEL = "wopr.tool-image"
+POOL_LABEL = "wopr.sandbox-owner"
+NOBODY = 65534
+#Runs as root in the container after each tool run: empties the shared scratch directories and fails if anything
+#running as nobody survived, so the container is recycled rather than handed to the next run.
+CLEANUP = f"""
+import os, shutil, sys
+for directory in ("/tmp", "/var/tmp", "/dev/shm"):
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+left = [name for directory in ("/tmp", "/var/tmp", "/dev/shm") for name in os.listdir(directory)]
+survivors = []
+for pid in os.listdir("/proc"):
+    try:
+        if pid.isdigit() and os.stat("/proc/" + pid).st_uid == {NOBODY}:
+            survivors.append(pid)
+    except FileNotFoundError:
+        pass
+sys.exit(1 if left or survivors else 0)
+"""
 
-        # Create a Docker client
-        client = docker.from_env()
+def get_dependency_key(dependencies : List[str]) -> str:
+    #Order and duplicates don't change what gets installed, so they don't change the image either.
+    normalized = sorted(set(dependency.strip().lower() for dependency in dependencies if dependency.strip()))
+    return hashlib.sha256("\n".join([BASE_IMAGE] + normalized).encode("utf-8")).hexdigest()[:16]
 
-        # Define the Dockerfile as a multi-line string
+class ImageCache:
+    #One image per dependency set, tagged with its hash; the code is copied in for each run. Use is tracked with a
+    #marker file's mtime, and the least recently used images beyond `max_images` are removed.
+    def __init__(self, directory : str = "tool_image_cache", max_images : int = 16):
+        self.directory = directory
+        self.max_images = max_images
+        self.locks : Dict[str, asyncio.Lock] = {}
+        self.tasks : Set[asyncio.Task] = set()
+        self.client = None
+
+    @classmethod
+    def from_env(cls) -> 'ImageCache':
+        return cls(os.environ.get("WOPR-Tool-Image-Dir", "tool_image_cache"), int(os.environ.get("WOPR-Tool-Image-Cache-Size", "16")))
+
+    def get_client(self):
+        if self.client is None:
+            self.client = docker.from_env()
+        return self.client
+
+    def get_tag(self, dependencies : List[str]) -> str:
+        return IMAGE_REPOSITORY + ":" + get_dependency_key(dependencies)
+
+    def touch(self, tag : str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        marker = os.path.join(self.directory, tag.split(":")[-1])
+        with open(marker, "a"):
+            pass
+        os.utime(marker)
+
+    def last_used(self, tag : str) -> float:
+        #Images without a marker were never used since this cache started tracking them, so they go first.
+        marker = os.path.join(self.directory, tag.split(":")[-1])
+        return os.path.getmtime(marker) if os.path.exists(marker) else 0
+
+    def exists(self, tag : str) -> bool:
+        try:
+            self.get_client().images.get(tag)
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+
+    def build(self, tag : str, dependencies : List[str]) -> None:
         dockerfile = f"""
-        FROM python:3.12-slim
-        COPY . /app
+        FROM {BASE_IMAGE}
         WORKDIR /app
         """
         if len(dependencies) > 0:
-            dockerfile += f"""RUN pip install {' '.join(dependencies)}"""
+            dockerfile += f"""RUN pip install --no-cache-dir {' '.join(sorted(set(dependencies)))}"""
         dockerfile += f"""
         CMD ["python", "script.py"]
         """
+        start = time.perf_counter()
+        self.get_client().images.build(fileobj=BytesIO(dockerfile.encode('utf-8')), rm=True, tag=tag, labels={IMAGE_LABEL: tag})
+        logging.info(f"Built tool image {tag} for {dependencies} in {time.perf_counter() - start:.1f}s")
+
+    def prune(self, keep : str) -> None:
+        images = []
+        for image in self.get_client().images.list(filters={"label": IMAGE_LABEL}):
+            tag = image.labels.get(IMAGE_LABEL)
+            if tag is None or tag == keep:
+                continue
+            images.append((self.last_used(tag), tag))
+        images.sort()
+        for _, tag in images[:max(0, len(images) + 1 - self.max_images)]:
+            try:
+                self.get_client().images.remove(tag)
+                marker = os.path.join(self.directory, tag.split(":")[-1])
+                if os.path.exists(marker):
+                    os.remove(marker)
+                logging.info(f"Pruned tool image {tag}")
+            except docker.errors.APIError as e:
+                #Still used by a container, try again after the next build.
+                logging.info(f"Could not prune tool image {tag}: {e}")
+
+    async def ensure(self, dependencies : List[str]) -> str:
+        tag = self.get_tag(dependencies)
+        lock = self.locks.setdefault(tag, asyncio.Lock())
+        async with lock:
+            if not await asyncio.to_thread(self.exists, tag):
+                await asyncio.to_thread(self.build, tag, dependencies)
+                await asyncio.to_thread(self.prune, tag)
+        self.touch(tag)
+        return tag
+
+    def prebuild(self, dependencies : List[str]) -> None:
+        #Fire and forget, so the first call of a new tool doesn't pay for the build.
+        async def build():
+            try:
+                await self.ensure(dependencies)
+            except Exception as e:
+                logging.warning(f"Could not prebuild tool image for {dependencies}: {e!r}")
+        task = asyncio.create_task(build())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+class SandboxContainer:
+    def __init__(self, container, tag : str):
+        self.container = container
+        self.tag = tag
+        self.uses = 0
+        self.last_used = time.monotonic()
+        self.clean = True
+
+class ContainerPool:
+    #Warm sandbox containers per image, cleaned between runs and recycled after `max_uses` runs or any failure.
+    #`min_warm` are kept for images used within `idle_timeout`; other idle containers are removed.
+    def __init__(self, images : ImageCache, min_warm : int = 1, max_uses : int = 50, idle_timeout : float = 600):
+        self.images = images
+        self.min_warm = min_warm
+        self.max_uses = max_uses
+        self.idle_timeout = idle_timeout
+        self.idle : Dict[str, List[SandboxContainer]] = {}
+        self.last_used : Dict[str, float] = {}
+        self.starting : Dict[str, int] = {}
+        self.tasks : Set[asyncio.Task] = set()
+        self.evictor : Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, images : ImageCache) -> 'ContainerPool':
+        return cls(images, int(os.environ.get("WOPR-Tool-Pool-Warm", "1")), int(os.environ.get("WOPR-Tool-Pool-Max-Uses", "50")), float(os.environ.get("WOPR-Tool-Pool-Idle", "600")))
+
+    def start_container(self, tag : str) -> SandboxContainer:
+        container = self.images.get_client().containers.run(tag, ["sleep", "infinity"], detach=True, init=True, labels={POOL_LABEL: str(os.getpid())})
+        return SandboxContainer(container, tag)
+
+    def remove_container(self, sandbox : SandboxContainer) -> None:
+        try:
+            sandbox.container.remove(force=True)
+        except docker.errors.APIError as e:
+            logging.warning(f"Could not remove sandbox container {sandbox.container.id[:12]}: {e}")
+
+    def remove_orphans(self) -> None:
+        #Containers left behind by a pool whose process is gone.
+        for container in self.images.get_client().containers.list(all=True, filters={"label": POOL_LABEL}):
+            owner = int(container.labels.get(POOL_LABEL, "0"))
+            try:
+                os.kill(owner, 0)
+            except (ProcessLookupError, ValueError):
+                container.remove(force=True)
+            except PermissionError:
+                pass
+
+    def schedule(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def replenish(self, tag : str) -> None:
+        #Containers already starting count towards min_warm, so concurrent acquires don't each start one.
+        try:
+            while len(self.idle.get(tag, [])) + self.starting.get(tag, 0) < self.min_warm:
+                self.starting[tag] = self.starting.get(tag, 0) + 1
+                try:
+                    sandbox = await asyncio.to_thread(self.start_container, tag)
+                finally:
+                    self.starting[tag] -= 1
+                self.idle.setdefault(tag, []).append(sandbox)
+        except Exception as e:
+            logging.warning(f"Could not warm a sandbox for {tag}: {e!r}")
+
+    async def evict(self) -> None:
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            now = time.monotonic()
+            for tag, sandboxes in list(self.idle.items()):
+                if now - self.last_used.get(tag, 0) >= self.idle_timeout:
+                    keep = []
+                else:
+                    #Surplus from a burst: keep the min_warm most recently used, drop the rest once they've idled out.
+                    sandboxes.sort(key=lambda sandbox: sandbox.last_used, reverse=True)
+                    keep = sandboxes[:self.min_warm] + [sandbox for sandbox in sandboxes[self.min_warm:] if now - sandbox.last_used < self.idle_timeout]
+                evicted = [sandbox for sandbox in sandboxes if sandbox not in keep]
+                if len(keep) > 0:
+                    self.idle[tag] = keep
+                else:
+                    del self.idle[tag]
+                for sandbox in evicted:
+                    await asyncio.to_thread(self.remove_container, sandbox)
+                if len(evicted) > 0:
+                    logging.info(f"Evicted {len(evicted)} idle sandboxes for {tag}")
+
+    async def acquire(self, dependencies : List[str]) -> SandboxContainer:
+        if self.evictor is None:
+            await asyncio.to_thread(self.remove_orphans)
+            self.evictor = asyncio.create_task(self.evict())
+        tag = await self.images.ensure(dependencies)
+        self.last_used[tag] = time.monotonic()
+        idle = self.idle.get(tag, [])
+        sandbox = idle.pop() if len(idle) > 0 else await asyncio.to_thread(self.start_container, tag)
+        self.schedule(self.replenish(tag))
+        return sandbox
+
+    def release(self, sandbox : SandboxContainer, healthy : bool) -> None:
+        sandbox.uses += 1
+        sandbox.last_used = time.monotonic()
+        if healthy and sandbox.clean and sandbox.uses < self.max_uses:
+            self.idle.setdefault(sandbox.tag, []).append(sandbox)
+        else:
+            self.schedule(asyncio.to_thread(self.remove_container, sandbox))
+
+    def execute(self, sandbox : SandboxContainer, python_code : str, timeout : float, on_text : Optional[Callable[[Optional[str]], None]] = None) -> ScriptResult:
+        run_id = uuid4().hex
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode="w") as tar:
+            directory = tarfile.TarInfo(run_id)
+            directory.type = tarfile.DIRTYPE
+            directory.mode = 0o700
+            directory.uid = directory.gid = NOBODY
+            tar.addfile(directory)
+            script = python_code.encode("utf-8")
+            info = tarfile.TarInfo(run_id + "/script.py")
+            info.size = len(script)
+            info.uid = info.gid = NOBODY
+            tar.addfile(info, BytesIO(script))
+        if not sandbox.container.put_archive("/tmp", archive.getvalue()):
+            return ScriptResult("", -1)
+        api = self.images.get_client().api
+        exec_id = api.exec_create(sandbox.container.id, ["timeout", "-s", "KILL", str(max(1, math.ceil(timeout))), "python", "-u", "script.py"], user="nobody", workdir="/tmp/" + run_id)["Id"]
+        capture = OutputCapture(ToolExecutor.max_output)
+        for chunk in api.exec_start(exec_id, stream=True):
+            text = capture.feed(chunk)
+            if on_text is not None and text != "":
+                on_text(text)
+        exit_code = api.exec_inspect(exec_id)["ExitCode"]
+        #kill -1 takes down anything the script left running, and the kill itself, so its exit code means nothing.
+        sandbox.container.exec_run(["sh", "-c", "kill -9 -1"], user="nobody")
+        cleanup = sandbox.container.exec_run(["python", "-I", "-c", CLEANUP], user="root")
+        if cleanup.exit_code != 0:
+            logging.warning(f"Sandbox {sandbox.container.id[:12]} could not be cleaned up, recycling it")
+            sandbox.clean = False
+        return ScriptResult(capture.output, exit_code)
+
+    async def run(self, python_code : str, dependencies : List[str], timeout : float = 60, on_output : Optional[OutputCallback] = None) -> ScriptResult:
+        sandbox = await self.acquire(dependencies)
+        healthy = False
+        loop = asyncio.get_running_loop()
+        try:
+            if on_output is None:
+                result = await loop.run_in_executor(tool_executor, self.execute, sandbox, python_code, timeout)
+            else:
+                #The exec is read on a tool thread, which hands text back to the loop; None marks the end.
+                texts : asyncio.Queue = asyncio.Queue()
+                def on_text(text : Optional[str]) -> None:
+                    loop.call_soon_threadsafe(texts.put_nowait, text)
+                def execute() -> ScriptResult:
+                    try:
+                        return self.execute(sandbox, python_code, timeout, on_text)
+                    finally:
+                        on_text(None)
+                future = loop.run_in_executor(tool_executor, execute)
+                while True:
+                    text = await texts.get()
+                    if text is None:
+                        break
+                    await on_output(text)
+                result = await future
+            healthy = result.ok
+            return result
+        finally:
+            #If the run was cancelled the container is still busy; releasing it unhealthy removes it, which ends the exec.
+            self.release(sandbox, healthy)
+
+    async def close(self) -> None:
+        if self.evictor is not None:
+            self.evictor.cancel()
+            self.evictor = None
+        for sandboxes in self.idle.values():
+            for sandbox in sandboxes:
+                await asyncio.to_thread(self.remove_container, sandbox)
+        self.idle = {}
+
+#Tool runs block a thread for as long as the script runs, so they get their own threads instead of the default executor.
+tool_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("WOPR-Tool-Threads", "8")), thread_name_prefix="tool")
+image_cache = ImageCache.from_env()
+container_pool = ContainerPool.from_env(image_cache)
+
+class DockerExecutor(ToolExecutor):
+    #Runs any tool, with its pip packages and network access, in a pooled sandbox container.
+    name = "docker"
+    def __init__(self, pool : ContainerPool):
+        self.pool = pool
+    def supports(self, tool : ToolDefinition) -> bool:
+        return True
+    async def run(self, python_code : str, dependencies : List[str], timeout : float = 60, on_output : Optional[OutputCallback] = None) -> ScriptResult:
+        return await self.pool.run(python_code, dependencies, timeout, on_output)
 
-        # Send the Dockerfile to the Docker daemon
-        image, _ = client.images.build(path=temp_dir, fileobj=BytesIO(dockerfile.encode('utf-8')), rm=True, tag="python_script_runner")
+register_executor(DockerExecutor(container_pool))
 
-        # Run the container
-        container = client.containers.run("python_script_runner", detach=True, volumes={temp_dir: {'bind': '/app', 'mode': 'rw'}})
+async def execute_python_script(python_code : str, dependencies : List[str] = [], timeout : float = 60) -> ScriptResult:
+    return await container_pool.run(python_code, dependencies, timeout)
 
-        # Wait for the container to finish
-        container.wait()
+async def run_python_script(python_code, dependencies=[], timeout=60):
+    return (await execute_python_script(python_code, dependencies, timeout)).output
 
-        # Retrieve the results
-        output = container.logs()
-        container.remove()
-        return output.decode('utf-8')
-    
 if __name__ == "__main__":
     python_code = """
 import wolframalpha
@@ -54,5 +357,4 @@ def wolfram_alpha_query(query: str, api_key: str) -> None:
 
 assert("42" in wolfram_alpha_query('What is the meaning of life?', '3P3L95-Q3UKREU8R3'))
     """
-    print(run_python_script(python_code, ["wolframalpha"]), end="")
-    
\ No newline at end of file
+    print(asyncio.run(run_python_script(python_code, ["wolframalpha"])), end="")
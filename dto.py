@@ -1,8 +1,12 @@
 from __future__ import annotations
 from abc import abstractmethod
-from typing import Any, Dict
+from typing import Any, Callable, Dict
 from dataclasses import dataclass
 from datetime import datetime
+from enum import Enum
+import hashlib
+import json
+import sys
 from typing import AsyncGenerator, List, Optional, Union
 from uuid import uuid4
 import discord
@@ -42,7 +46,7 @@ class Message:
                        message.id)
         else:
             raise NotImplementedError("Not implemented")
-        
+
 
 @dataclass
 class Channel:
@@ -92,43 +96,212 @@ class User:
     def get_discord_user(self, discord_client:discord.Client) -> Optional[discord.User]:
         return discord_client.get_user(int(self.id))
     
+class Role(str, Enum):
+    SYSTEM = "system"
+    USER = "user"
+    ASSISTANT = "assistant"
+    FUNCTION = "function"
+    TOOL = "tool"
+    TOOL_CALL = "tool_call"
+    @staticmethod
+    def parse(role : str) -> Union[Role, str]:
+        try:
+            return Role(role)
+        except ValueError:
+            return sys.intern(role)
+
+class ChatMessage:
+    __slots__ = ("role", "content", "name")
+    def __init__(self, role : Union[Role, str], content : str, name : Optional[str] = None):
+        self.role = Role.parse(role)
+        self.content = content
+        self.name = name
+    @staticmethod
+    def from_dict(message : Union[ChatMessage, dict[str, str]]) -> ChatMessage:
+        if isinstance(message, ChatMessage):
+            return message
+        return ChatMessage(message["role"], message["content"], message.get("name", None))
+    @property
+    def role_name(self) -> str:
+        return self.role.value if isinstance(self.role, Role) else self.role
+    def to_dict(self) -> dict[str, str]:
+        if self.name is None:
+            return {"role":self.role_name, "content":self.content}
+        return {"role":self.role_name, "name":self.name, "content":self.content}
+    def render(self) -> str:
+        return self.role_name + " " + (self.name or "") + ": " + self.content + "\n"
+    def __getitem__(self, key : str) -> str:
+        return self.to_dict()[key]
+    def get(self, key : str, default : Any = None) -> Any:
+        return self.to_dict().get(key, default)
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ChatMessage) and (self.role, self.content, self.name) == (other.role, other.content, other.name)
+    def __repr__(self) -> str:
+        return str(self.to_dict())
+
+class MessageNode(ChatMessage):
+    #An immutable, content addressed link in a conversation history; histories that share a prefix share its nodes.
+    __slots__ = ("parent", "digest", "length", "__weakref__")
+    def __init__(self, message : ChatMessage, parent : Optional[MessageNode] = None, digest : Optional[bytes] = None):
+        super().__init__(message.role, message.content, message.name)
+        self.parent = parent
+        self.length = 1 + (parent.length if parent is not None else 0)
+        #Nodes loaded from the database already know their id.
+        if digest is None:
+            key = [parent.id if parent is not None else None, self.role_name, self.name, self.content]
+            digest = hashlib.sha1(json.dumps(key).encode("utf-8")).digest()
+        self.digest = digest
+    @property
+    def id(self) -> str:
+        return self.digest.hex()
+    @property
+    def message(self) -> ChatMessage:
+        return self
+
+class MessageStore:
+    #A Conversation's messages as a persistent linked list of MessageNodes, so forks only copy the head. Only the
+    #head id is pickled; Database stores the nodes.
+    __slots__ = ("head", "head_id", "records", "payload", "system", "transcript")
+    def __init__(self, messages : Optional[List[Union[ChatMessage, dict[str, str]]]] = None, head : Optional[MessageNode] = None):
+        self.head = head
+        for message in messages or []:
+            self.head = MessageNode(ChatMessage.from_dict(message), self.head)
+        self.head_id : Optional[str] = None
+        self.invalidate()
+    def invalidate(self) -> None:
+        self.records : Optional[List[ChatMessage]] = None
+        #Payload starts with the conversation's system messages, and is rebuilt when they change.
+        self.payload : Optional[List[dict[str, str]]] = None
+        self.system : tuple[str, ...] = ()
+        self.transcript : Optional[str] = None
+    def fork(self) -> MessageStore:
+        store = MessageStore(head=self.head)
+        store.head_id = self.head_id
+        return store
+    def resolve(self, load_node : Callable[[str], MessageNode]) -> None:
+        if self.head_id is not None:
+            self.head = load_node(self.head_id)
+            self.head_id = None
+            self.invalidate()
+    def get_records(self) -> List[ChatMessage]:
+        if self.records is None:
+            records = []
+            node = self.head
+            while node is not None:
+                records.append(node)
+                node = node.parent
+            records.reverse()
+            self.records = records
+        return self.records
+    def append(self, message : ChatMessage) -> None:
+        self.head = MessageNode(message, self.head)
+        if self.records is not None:
+            self.records.append(self.head)
+        if self.payload is not None:
+            self.payload.append(self.head.to_dict())
+        if self.transcript is not None:
+            self.transcript += self.head.render()
+    def pop(self) -> ChatMessage:
+        if self.head is None:
+            raise IndexError("pop from an empty conversation")
+        message = self.head
+        self.head = self.head.parent
+        if self.records is not None:
+            self.records.pop()
+        if self.payload is not None:
+            self.payload.pop()
+        self.transcript = None
+        return message
+    def descends_from(self, node_id : str) -> bool:
+        digest = bytes.fromhex(node_id)
+        node = self.head
+        while node is not None:
+            if node.digest == digest:
+                return True
+            node = node.parent
+        return False
+    def get_payload(self, system : tuple[str, ...] = ()) -> List[dict[str, str]]:
+        #The list is shared with later calls, so callers must not modify it.
+        if self.payload is None or self.system != system:
+            self.payload = [{"role":"assistant","content":value} for value in system] + [message.to_dict() for message in self.get_records()]
+            self.system = system
+        return self.payload
+    def render(self) -> str:
+        if self.transcript is None:
+            self.transcript = "".join(message.render() for message in self.get_records())
+        return self.transcript
+    def __getstate__(self) -> dict[str, Optional[str]]:
+        return {"head": self.head.id if self.head is not None else self.head_id}
+    def __setstate__(self, state : Union[dict[str, Optional[str]], List[dict[str, str]]]) -> None:
+        self.head = None
+        self.head_id = None
+        if isinstance(state, list):
+            #Stores pickled before nodes were shared kept their messages inline.
+            for message in state:
+                self.head = MessageNode(ChatMessage.from_dict(message), self.head)
+        else:
+            self.head_id = state["head"]
+        self.invalidate()
+    def __deepcopy__(self, memo) -> MessageStore:
+        return self.fork()
+    def __copy__(self) -> MessageStore:
+        return self.fork()
+    def __len__(self) -> int:
+        return self.head.length if self.head is not None else 0
+    def __iter__(self):
+        return iter(self.get_records())
+    def __getitem__(self, index):
+        return self.get_records()[index]
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, MessageStore):
+            return False
+        if self.head is None or other.head is None:
+            return self.head is other.head and self.head_id == other.head_id
+        return self.head.id == other.head.id
+
 @dataclass
 class Conversation:
     system:dict[str,str]
-    messages:List[dict[str, str]]
+    messages:MessageStore
     summary:str
-    id:str = str(uuid4().hex)
+    id:str = dataclasses.field(default_factory=lambda: uuid4().hex)
     @staticmethod
     def new_conversation(system:str = "You are a helpful AI assistant.") -> Conversation:
-        return Conversation({"system":system},[], "The start of a brand new conversation")
+        return Conversation({"system":system}, MessageStore(), "The start of a brand new conversation")
+    @property
+    def store(self) -> MessageStore:
+        #Conversations saved before MessageStore existed, or whose messages were replaced with a list, are converted on first use.
+        if not isinstance(self.messages, MessageStore):
+            self.messages = MessageStore(self.messages)
+        return self.messages
     def set_system(self, system : str, message : str = "") -> None:
         self.system[system] = message
     def delete_system(self, system : str) -> None:
         del self.system[system]
     def get_conversation(self) -> List[dict[str, str]]:
-        messages : List[dict[str,str]] = [{"role":"assistant","content":value} for value in self.system.values()]
-        messages.extend(self.messages)
-        copy : List[dict[str,str]] = []
-        for x in range(0, len(messages)):
-            copy.append(messages[x])
-        return copy
+        return self.store.get_payload(tuple(self.system.values()))
     def add_user(self, user : str) -> None:
         if user is not None:
-            self.messages.append({"role":"user","content":user})
+            self.store.append(ChatMessage(Role.USER, user))
     def add_assistant(self, assistant : str) -> None:
         if assistant is not None:
-            self.messages.append({"role":"assistant","content":assistant})
+            self.store.append(ChatMessage(Role.ASSISTANT, assistant))
     def delete_last_message(self) -> None:
-        self.messages.pop()
+        self.store.pop()
+    def fork(self) -> Conversation:
+        return Conversation(dict(self.system), self.store.fork(), self.summary)
+    def snapshot(self) -> Conversation:
+        return Conversation(dict(self.system), self.store.fork(), self.summary, self.id)
+    def rollback(self, snapshot : Conversation) -> None:
+        self.system = dict(snapshot.system)
+        self.messages = snapshot.store.fork()
+        self.summary = snapshot.summary
     def add_tool_call(self, tool_call) -> None:
-        self.messages.append({"role":"tool_call", "content":tool_call})
+        self.store.append(ChatMessage(Role.TOOL_CALL, tool_call))
     def add_tool_call_result(self, tool_call_result : dict[str,str]) -> None:
-        self.messages.append({"role":tool_call_result["role"], "name":tool_call_result["name"], "content":tool_call_result["content"]})
+        self.store.append(ChatMessage(tool_call_result["role"], tool_call_result["content"], tool_call_result["name"]))
     def __str__(self) -> str:
-        convo = ""
-        for message in self.get_conversation():
-            convo += message["role"] + " " + message.get("name", "") + ": " + message["content"] + "\n"
-        return convo
+        return "".join("assistant : " + value + "\n" for value in self.system.values()) + self.store.render()
 
 @dataclass
 class UserValues:
@@ -250,6 +423,8 @@ class ToolDefinition:
     pip_packages: List[str] = dataclasses.field(default_factory=list[str]) #The pip packages required for the tool
     python: str = "" #The python code for the tool
     example_invocation: str = "" #An example invocation of the tool that has all the parameters supplied and asserts the results are correct. This will be appended to the code and run to verify the tool works. Do not create any unnecessary objects, just invoke the function with the parameters then assert result.txt has the correct value.
+    needs_network: bool = True #False only if the tool never makes network requests, for example a calculation or a text conversion.
+    cacheable: bool = False #True only if the tool is a pure lookup or conversion: the same arguments always give the same output and running it has no side effects. False if it depends on the current time, random values or data that changes, or if it writes anything.
     
     def getCode(self, args) -> str:
         code = self.python
@@ -1,15 +1,24 @@
 from __future__ import annotations
 from abc import abstractmethod
+import asyncio
 import inspect
+import json
+import logging
 import os
-from typing import AsyncGenerator, List, Optional
-from bs4 import BeautifulSoup
-import pynytimes
-from wolframalpha import Client as WolframAlphaClient
-import wikipedia
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import requests
+from typing import AsyncGenerator, Callable, List, Optional, Tuple
+import aiohttp
+from html_text import extract_text_blocks, extract_text_blocks_async
+from http_client import HttpResponse, http_client
+from lazy import lazy_import
+from response_cache import response_cache
+from similarity import normalize
+
+bs4 = lazy_import("bs4")
+pynytimes = lazy_import("pynytimes")
+wolframalpha = lazy_import("wolframalpha")
+wikipedia = lazy_import("wikipedia")
+sklearn_text = lazy_import("sklearn.feature_extraction.text")
+sklearn_pairwise = lazy_import("sklearn.metrics.pairwise")
 
 class DataSource:
     def __init__(self, name : str, url : str, roles : List[str]):
@@ -19,6 +28,19 @@ class DataSource:
     @abstractmethod
     async def query(self, query : str, context:Optional[dict[str,str]]) -> AsyncGenerator[str, None]:
         pass
+    async def cached_results(self, query : str, loader : Callable[[], List[str]], ttl : Optional[float] = None) -> List[str]:
+        #Runs a blocking client library lookup in a thread, going through the shared response cache. An empty result is
+        #cached as a miss.
+        key = self.name + ":" + query
+        entry = response_cache.get(key)
+        if entry is not None and entry.fresh:
+            return [] if entry.negative else json.loads(entry.value)
+        results = [result for result in await asyncio.to_thread(loader) if result]
+        if len(results) == 0:
+            response_cache.put(key, b"[]", negative=True)
+        else:
+            response_cache.put(key, json.dumps(results).encode("utf-8"), ttl=ttl)
+        return results
 
 class SpecializedDataSource(DataSource):
     def __init__(self, name : str, url : str, roles : List[str]):
@@ -42,50 +64,64 @@ class Endpoint:
         self.role = role
 
 class ExternalDataSource(DataSource):
+    #Bounds on what one html endpoint costs: bytes downloaded, and characters of text extracted from them.
+    max_bytes = int(os.environ.get("WOPR-Scrape-Max-Bytes", str(2 * 1024 * 1024)))
+    max_chars = int(os.environ.get("WOPR-Scrape-Max-Chars", "8000"))
+    extract_in_process = os.environ.get("WOPR-Extract-In-Process", "false").lower() == "true"
     def __init__(self, name : str, url : str, roles : List[str], endpoints : List[Endpoint]):
         super().__init__(name, url, roles)
         self.endpoints = endpoints
+    def get_url(self, endpoint : Endpoint, query : str, context : Optional[dict[str, str]]) -> str:
+        url = self.url + endpoint.path + "?"
+        params = []
+        for param in endpoint.query_params:
+            if param.parameter_type == "query":
+                params.extend([param.name + "=" + query])
+                continue
+            if context is not None and param.name in context:
+                params.extend([param.name + "=" + str(context[param.name])])
+                continue
+            if param.required and param.default is not None:
+                params.extend([param.name + "=" + param.default])
+                continue
+            if param.required:
+                raise ValueError("Missing required parameter: " + param.name)
+            if param.default is not None:
+                params.extend([param.name + "=" + param.default])
+                continue
+            params.extend([param.name])
+        return url + "&".join(params)
+    async def fetch(self, endpoint : Endpoint, query : str, context : Optional[dict[str, str]]) -> Tuple[Endpoint, HttpResponse]:
+        url = self.get_url(endpoint, query, context)
+        if endpoint.method == "GET":
+            return endpoint, await http_client.get(url, max_bytes=self.max_bytes if endpoint.response_format == "html" else None)
+        elif endpoint.method == "POST":
+            return endpoint, await http_client.post(url, json=context, headers={"Content-Type": "application/json"})
+        raise ValueError("Invalid method: " + endpoint.method)
     async def query(self, query:str, context:Optional[dict[str, str]], roles : List[str] = ["search"]) -> AsyncGenerator[str, None]:
+        #All relevant endpoints are queried at once and results are yielded in the order the responses arrive. If the
+        #caller stops early, the fetches still running are cancelled and waited for, so none is left behind.
         relevant_endpoints = [endpoint for endpoint in self.endpoints if endpoint.role in roles]
-        for endpoint in relevant_endpoints:
-            url = self.url + endpoint.path + "?"
-            params = []
-            for param in endpoint.query_params:
-                if param.parameter_type == "query":
-                    params.extend([param.name + "=" + query])
-                    continue
-                if context is not None and param.name in context:
-                    params.extend([param.name + "=" + str(context[param.name])])
-                    continue
-                if param.required and param.default is not None:
-                    params.extend([param.name + "=" + param.default])
+        tasks = [asyncio.create_task(self.fetch(endpoint, query, context)) for endpoint in relevant_endpoints]
+        try:
+            for next_response in asyncio.as_completed(tasks):
+                try:
+                    endpoint, response = await next_response
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logging.warning(f"{self.name} request failed: {e!r}")
                     continue
-                if param.required:
-                    raise ValueError("Missing required parameter: " + param.name)
-                if param.default is not None:
-                    params.extend([param.name + "=" + param.default])
+                if response.status != 200:
                     continue
-                params.extend([param.name])
-            url += "&".join(params)
-            if endpoint.method == "GET":
-                response = requests.get(url)
-            elif endpoint.method == "POST":
-                response = requests.post(url, json=context, headers={"Content-Type": "application/json"})
-            else:
-                raise ValueError("Invalid method: " + endpoint.method)
-            if response.status_code == 200:
-                content = response.content.decode("utf-8")
+                content = response.text()
                 if endpoint.response_format == "html":
-                    soup = BeautifulSoup(content, "html.parser")
-                    for element in soup.find_all():
-                        if element.parent.name in ["nav", "header", "footer", "aside", "html", "head", "meta", "link", "script", "style"]:
-                            continue
-                        yield element.strip()
+                    for text in await extract_text_blocks_async(content, self.max_chars, in_process=self.extract_in_process):
+                        yield text
                 else:
                     yield content
-            else:
-                continue
-        raise StopIteration
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
   
 class WikipediaDataSource(SpecializedDataSource):
     def __init__(self):
@@ -102,18 +138,21 @@ class WikipediaDataSource(SpecializedDataSource):
             for option in e.options[:5]:
                 try:
                     summary += self.get_wiki_summary(option) + "\n\n"
-                except wikipedia.exceptions.DisambiguationError:
+                except (wikipedia.exceptions.DisambiguationError, wikipedia.exceptions.PageError):
                     continue
             return summary 
+        except (wikipedia.exceptions.PageError, IndexError):
+            return ""
     async def query(self, query: str, context: Optional[dict[str,str]] = None) -> AsyncGenerator[str, None]:
         #TODO: Get this to yield all topic summaries.
-        yield self.get_wiki_suggestion(query)
+        for result in await self.cached_results(query, lambda: [self.get_wiki_suggestion(query)]):
+            yield result
         
 class WolframAlphaDataSource(SpecializedDataSource):
     def __init__(self):
         super().__init__("Wolfram|Alpha", "https://www.wolframalpha.com", ["compute", "research"])
-        self.client = WolframAlphaClient(os.environ.get("WolframAlpha-App-ID"))
-    async def query(self, query: str, context: Optional[dict[str,str]] = None) -> AsyncGenerator[str, None]:
+        self.client = wolframalpha.Client(os.environ.get("WolframAlpha-App-ID"))
+    def get_answer(self, query : str) -> List[str]:
         res = self.client.query(query)
         try:
             if res["didyoumeans"] is not None:
@@ -126,20 +165,17 @@ class WolframAlphaDataSource(SpecializedDataSource):
         try:
             res = next(res.results)
             if res.text is not None:
-                yield res.text
+                return [res.text]
             else:
-                yield res.subpod.img.src
+                return [res.subpod.img.src]
         except:
-            raise StopIteration
+            return []
+    async def query(self, query: str, context: Optional[dict[str,str]] = None) -> AsyncGenerator[str, None]:
+        for result in await self.cached_results(query, lambda: self.get_answer(query)):
+            yield result
         
-def get_text_from_html(html) -> str:
-    navigation_elements = ["nav", "header", "footer", "aside", "html", "head", "meta", "link", "script", "style"]
-    non_navigation_text = []
-    soup = BeautifulSoup(html, "html.parser")
-    for tag in soup.find_all(text=True):
-        if tag.parent.name not in navigation_elements:
-            non_navigation_text.append(tag.strip())
-    return "\n".join(non_navigation_text)
+def get_text_from_html(html : str, max_chars : Optional[int] = 8000, max_tokens : Optional[int] = None) -> str:
+    return "\n".join(extract_text_blocks(html, max_chars, max_tokens))
 
 class NewYorkTimesDataSource(DataSource):
     def __init__(self):
@@ -147,35 +183,34 @@ class NewYorkTimesDataSource(DataSource):
         self.nytimes = pynytimes.NYTAPI(os.environ.get("NYTimes-API_Key", ""), parse_dates=True)
     async def query(self, query: str, context : Optional[dict[str,str]] = None) -> AsyncGenerator[str, None]:
         # Send the query to the external source and get the response
-        res = self.nytimes.article_search(query=query)    
-        for x in res:
-            yield x["abstract"]
-        raise StopIteration    
+        for abstract in await self.cached_results(query, lambda: [x["abstract"] for x in self.nytimes.article_search(query=query)]):
+            yield abstract
+
 class GoogleNewsDataSource(DataSource):
     def __init__(self):
         super().__init__("Google News", "https://news.google.com", ["news"])
     async def query(self, query: str, context: Optional[dict[str,str]] = None) -> AsyncGenerator[str, None]:
         # Send the query to the external source and get the response
-        res = requests.get("https://news.google.com/search?q=" + query)
-        if res.status_code!= 200:
-            raise StopIteration("Could not get a response from Google News: " + str(res.status_code))
-        soup = BeautifulSoup(res.content, "html.parser")
+        res = await http_client.get("https://news.google.com/search?q=" + query)
+        if res.status != 200:
+            logging.warning("Could not get a response from Google News: " + str(res.status))
+            return
+        soup = await asyncio.to_thread(bs4.BeautifulSoup, res.content, "html.parser")
         for x in soup.find_all("div", class_="g"):
             yield x.text
-        raise StopIteration
     
 class GoogleSearchDataSource(DataSource):
     def __init__(self):
         super().__init__("Google Search", "https://www.google.com", ["search"])
     async def query(self, query: str, context: Optional[dict[str,str]] = None) -> AsyncGenerator[str, None]:
         # Send the query to the external source and get the response
-        res = requests.get("https://www.google.com/search?q=" + query)
-        if res.status_code != 200:
-            raise StopIteration("Could not get a response from Google: " + str(res.status_code))
-        soup = BeautifulSoup(res.content, "html.parser")
+        res = await http_client.get("https://www.google.com/search?q=" + query)
+        if res.status != 200:
+            logging.warning("Could not get a response from Google: " + str(res.status))
+            return
+        soup = await asyncio.to_thread(bs4.BeautifulSoup, res.content, "html.parser")
         for x in soup.find_all("h3"):
             yield x.text
-        raise StopIteration
 
 def get_jaccard_similarity(str1 : str, str2 : str, threshold_jac :float=0.4) -> bool:
     set1 = set(str1.split())
@@ -185,20 +220,15 @@ def get_jaccard_similarity(str1 : str, str2 : str, threshold_jac :float=0.4) ->
     return intersection / union >= threshold_jac
 
 def get_cosine_similarity(string1: str, string2: str, threshold_cos: float) -> bool:
-    vectorizer = CountVectorizer()
+    vectorizer = sklearn_text.CountVectorizer()
     vectors = vectorizer.fit_transform([string1, string2])
-    cosine_sim = cosine_similarity(vectors)[0][1]
+    cosine_sim = sklearn_pairwise.cosine_similarity(vectors)[0][1]
     return cosine_sim >= threshold_cos
 
 def like(string1:str, string2:str, threshold_jac : float = 0.4, threshold_cos : float = 0.6):
-    # Remove unnecessary characters and convert to lowercase
-    string1 = ''.join(c for c in string1 if c.isalnum() or c.isspace()).lower().strip()
-    string2 = ''.join(c for c in string2 if c.isalnum() or c.isspace()).lower().strip()
-    # Remove common prefixes
-    if string1.startswith("the"):
-        string1 = string1[4:]
-    if string2.startswith("the"):
-        string2 = string2[4:]
+    #For many strings at once use similarity.like_matrix, which vectorizes the corpus once.
+    string1 = normalize(string1)
+    string2 = normalize(string2)
     # Return False if either string is empty
     if not string1 or not string2:
         return False
@@ -211,5 +241,29 @@ def like(string1:str, string2:str, threshold_jac : float = 0.4, threshold_cos :
     # Calculate Jaccard similarity
     return get_jaccard_similarity(string1, string2, threshold_jac) or get_cosine_similarity(string1, string2, threshold_cos)
 
+def get_data_source_classes(base : type = DataSource) -> List[type]:
+    classes = []
+    for cls in base.__subclasses__():
+        if not inspect.isabstract(cls) and len(inspect.signature(cls).parameters) == 0:
+            classes.append(cls)
+        classes.extend(get_data_source_classes(cls))
+    return classes
+
+data_source_instances : dict[type, DataSource] = {}
+
+def get_data_sources(role : str, base : type = DataSource) -> List[DataSource]:
+    #Only sources that can be built without arguments are discoverable; each is built once and reused.
+    sources = []
+    for cls in get_data_source_classes(base):
+        if cls not in data_source_instances:
+            try:
+                data_source_instances[cls] = cls()
+            except Exception as e:
+                logging.warning(f"Could not create data source {cls.__name__}: {e!r}")
+                continue
+        if role in data_source_instances[cls].role:
+            sources.append(data_source_instances[cls])
+    return sources
+
 def get_specialized_data_sources(datasource_type) -> List[SpecializedDataSource]:
-    return [type(ds)() for ds in SpecializedDataSource.__subclasses__() if not inspect.signature(ds).parameters and type(ds)().type == datasource_type]
+    return get_data_sources(datasource_type, SpecializedDataSource)
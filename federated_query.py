@@ -0,0 +1,70 @@
+from __future__ import annotations
+import asyncio
+from dataclasses import dataclass
+import logging
+from typing import AsyncGenerator, List, Optional
+from external_datasource import DataSource, get_data_sources
+from similarity import MinHashIndex
+
+ROLES = ["search", "news", "compute", "reference"]
+
+@dataclass
+class FederatedResult:
+    source:str
+    role:str
+    text:str
+
+async def drain(source : DataSource, role : str, query : str, context : Optional[dict[str, str]], results : asyncio.Queue) -> None:
+    try:
+        async for text in source.query(query, context):
+            await results.put(FederatedResult(source.name, role, text))
+    except Exception as e:
+        logging.warning(f"{source.name} failed: {e!r}")
+    finally:
+        results.put_nowait(None)
+
+async def merge_queries(query : str, roles : List[str], context : Optional[dict[str, str]] = None, sources : Optional[List[DataSource]] = None) -> AsyncGenerator[FederatedResult, None]:
+    #Every source is queried at once and results are yielded in arrival order. Closing the generator cancels the rest.
+    if sources is None:
+        picked = {}
+        for role in roles:
+            for source in get_data_sources(role):
+                picked.setdefault(id(source), (source, role))
+        targets = list(picked.values())
+    else:
+        targets = [(source, roles[0] if len(roles) > 0 else "") for source in sources]
+    results : asyncio.Queue = asyncio.Queue()
+    tasks = [asyncio.create_task(drain(source, role, query, context, results)) for source, role in targets]
+    running = len(tasks)
+    try:
+        while running > 0:
+            result = await results.get()
+            if result is None:
+                running -= 1
+            else:
+                yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def federated_query(query : str, roles : List[str] = ["search"], k : int = 5, deadline : float = 3.0, context : Optional[dict[str, str]] = None, sources : Optional[List[DataSource]] = None, dedupe : bool = True) -> List[FederatedResult]:
+    #The first `k` results from sources with one of `roles` within `deadline` seconds; sources still running are
+    #cancelled.
+    collected : List[FederatedResult] = []
+    index = MinHashIndex() if dedupe else None
+    async def collect():
+        merged = merge_queries(query, roles, context, sources)
+        try:
+            async for result in merged:
+                if index is not None and not index.add_if_new(len(collected), result.text):
+                    continue
+                collected.append(result)
+                if len(collected) >= k:
+                    break
+        finally:
+            await merged.aclose()
+    try:
+        await asyncio.wait_for(collect(), deadline)
+    except asyncio.TimeoutError:
+        logging.info(f"Federated query for {roles} hit the {deadline}s deadline with {len(collected)} results")
+    return collected
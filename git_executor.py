@@ -0,0 +1,103 @@
+from __future__ import annotations
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import logging
+import os
+import re
+import shlex
+import time
+from typing import Dict, List, Optional
+
+#Clone options that only shape what gets cloned. Anything else is refused: options like --upload-pack or --config
+#can make git run arbitrary commands, and the options come from a model's reading of a chat message.
+CLONE_OPTIONS = {"--branch", "-b", "--depth", "--single-branch", "--no-single-branch", "--no-tags", "--recurse-submodules",
+                 "--recursive", "--shallow-submodules", "--filter", "--sparse", "--quiet", "-q"}
+URL = re.compile(r"^(https?|git|ssh)://[^\s]+$|^[\w.-]+@[\w.-]+:[^\s]+$")
+DIRECTORY = re.compile(r"^[\w.-]+$")
+
+@dataclass
+class GitResult:
+    returncode:int
+    stdout:str
+    stderr:str
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+def parse_clone_options(options : Optional[str]) -> List[str]:
+    arguments = shlex.split(options or "")
+    for argument in arguments:
+        if argument.startswith("-") and argument.split("=", 1)[0] not in CLONE_OPTIONS:
+            raise ValueError("Unsupported git clone option: " + argument)
+    return arguments
+
+class GitExecutor:
+    #Runs git without a shell, at most `concurrency` commands at once. Clones go through a bare mirror per URL,
+    #fetched into at most every `refresh` seconds.
+    def __init__(self, root : str = "scratch/git", mirror_root : str = "scratch/git-mirrors", concurrency : int = 4, timeout : float = 600, refresh : float = 60):
+        self.root = root
+        self.mirror_root = mirror_root
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.refresh = refresh
+        self.semaphore : Optional[asyncio.Semaphore] = None
+        self.mirror_locks : Dict[str, asyncio.Lock] = {}
+        self.fetched : Dict[str, float] = {}
+
+    @classmethod
+    def from_env(cls) -> GitExecutor:
+        return cls(os.environ.get("WOPR-Git-Root", "scratch/git"), os.environ.get("WOPR-Git-Mirrors", "scratch/git-mirrors"), int(os.environ.get("WOPR-Git-Concurrency", "4")))
+
+    async def run(self, arguments : List[str], cwd : str, timeout : Optional[float] = None) -> GitResult:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        os.makedirs(cwd, exist_ok=True)
+        async with self.semaphore:
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec("git", *arguments, cwd=cwd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                           env=dict(os.environ, GIT_TERMINAL_PROMPT="0"))
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout or self.timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                process.kill()
+                await process.wait()
+                raise
+            logging.info(f"git {arguments[0]} exited with {process.returncode} in {time.perf_counter() - start:.2f}s")
+            return GitResult(process.returncode, stdout.decode("utf-8", errors="replace"), stderr.decode("utf-8", errors="replace"))
+
+    def mirror_path(self, url : str) -> str:
+        return os.path.abspath(os.path.join(self.mirror_root, hashlib.sha1(url.encode("utf-8")).hexdigest()[:16] + ".git"))
+
+    async def mirror(self, url : str) -> GitResult:
+        path = self.mirror_path(url)
+        async with self.mirror_locks.setdefault(url, asyncio.Lock()):
+            if not os.path.exists(path):
+                result = await self.run(["clone", "--mirror", "--", url, path], self.mirror_root)
+            elif time.monotonic() - self.fetched.get(url, float("-inf")) >= self.refresh:
+                result = await self.run(["fetch", "--prune", "origin"], path)
+            else:
+                return GitResult(0, "", "")
+            if result.ok:
+                self.fetched[url] = time.monotonic()
+            return result
+
+    async def clone(self, url : str, directory : str, options : Optional[str] = None) -> GitResult:
+        if not URL.match(url):
+            raise ValueError("Not a git URL: " + url)
+        if not DIRECTORY.match(directory) or directory in (".", ".."):
+            raise ValueError("Not a valid directory name: " + directory)
+        arguments = parse_clone_options(options)
+        mirrored = await self.mirror(url)
+        if not mirrored.ok:
+            return mirrored
+        source = self.mirror_path(url)
+        if any(argument.split("=", 1)[0] in ("--depth", "--filter") for argument in arguments):
+            #Plain paths are cloned with hardlinks, which ignores --depth and --filter; file:// goes through the transport.
+            source = "file://" + source
+        result = await self.run(["clone", *arguments, "--", source, directory], self.root)
+        if result.ok:
+            await self.run(["remote", "set-url", "origin", url], os.path.join(self.root, directory))
+        return result
+
+git_executor = GitExecutor.from_env()
@@ -0,0 +1,88 @@
+from __future__ import annotations
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+import multiprocessing
+import os
+import re
+from typing import List, Optional
+
+#Subtrees that never hold content worth putting in a prompt. Their text is dropped while parsing.
+SKIPPED_TAGS = {"nav", "header", "footer", "aside", "head", "script", "style", "noscript", "template", "svg", "iframe", "form", "button", "select"}
+BLOCK_TAGS = {"p", "div", "section", "article", "main", "li", "ul", "ol", "dl", "dt", "dd", "tr", "td", "th", "table", "br", "hr",
+              "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "figcaption", "title"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+WHITESPACE = re.compile(r"\s+")
+CHARS_PER_TOKEN = 4
+
+class TextExtractor(HTMLParser):
+    #Collects readable text blocks while the HTML is parsed, skipping navigation, script and style, and sets `done`
+    #once `max_chars` (or `max_tokens`) have been collected.
+    def __init__(self, max_chars : Optional[int] = None, max_tokens : Optional[int] = None):
+        super().__init__(convert_charrefs=True)
+        budgets = [budget for budget in (max_chars, max_tokens * CHARS_PER_TOKEN if max_tokens is not None else None) if budget is not None]
+        self.budget = min(budgets) if len(budgets) > 0 else None
+        self.blocks : List[str] = []
+        self.current : List[str] = []
+        self.size = 0
+        self.skip_depth = 0
+        self.done = False
+    def flush(self) -> None:
+        text = WHITESPACE.sub(" ", "".join(self.current)).strip()
+        self.current = []
+        if text == "" or self.done:
+            return
+        if self.budget is not None and self.size + len(text) >= self.budget:
+            text = text[:self.budget - self.size].rstrip()
+            self.done = True
+        if text != "":
+            self.blocks.append(text)
+            self.size += len(text) + 1
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS and tag not in VOID_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS and self.skip_depth == 0:
+            self.flush()
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            if self.skip_depth > 0:
+                self.skip_depth -= 1
+        elif tag in BLOCK_TAGS and self.skip_depth == 0:
+            self.flush()
+    def handle_data(self, data):
+        if self.skip_depth == 0 and not self.done:
+            self.current.append(data)
+            #Don't let one huge block run past the budget before its closing tag shows up.
+            if self.budget is not None and self.size + sum(len(x) for x in self.current) > 2 * self.budget:
+                self.flush()
+    def feed(self, data : str) -> None:
+        if not self.done:
+            super().feed(data)
+    def close(self) -> List[str]:
+        if not self.done:
+            super().close()
+            self.flush()
+        return self.blocks
+
+def extract_text_blocks(html : str, max_chars : Optional[int] = 8000, max_tokens : Optional[int] = None, chunk_size : int = 16384) -> List[str]:
+    extractor = TextExtractor(max_chars, max_tokens)
+    for start in range(0, len(html), chunk_size):
+        extractor.feed(html[start:start + chunk_size])
+        if extractor.done:
+            break
+    return extractor.close()
+
+process_pool : Optional[ProcessPoolExecutor] = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global process_pool
+    if process_pool is None:
+        #fork rather than spawn, since spawn re-runs the main module (WOPR.py) in every child.
+        process_pool = ProcessPoolExecutor(max_workers=int(os.environ.get("WOPR-Extract-Workers", "2")), mp_context=multiprocessing.get_context("fork"))
+    return process_pool
+
+async def extract_text_blocks_async(html : str, max_chars : Optional[int] = 8000, max_tokens : Optional[int] = None, in_process : bool = False) -> List[str]:
+    loop = asyncio.get_running_loop()
+    if in_process:
+        return await loop.run_in_executor(get_process_pool(), extract_text_blocks, html, max_chars, max_tokens)
+    return await asyncio.to_thread(extract_text_blocks, html, max_chars, max_tokens)
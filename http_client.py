@@ -0,0 +1,103 @@
+from __future__ import annotations
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Mapping, Optional
+import aiohttp
+from multidict import CIMultiDict
+from response_cache import get_max_age, response_cache
+
+@dataclass
+class HttpResponse:
+    url:str
+    status:int
+    headers:Mapping[str, str]
+    content:bytes
+    truncated:bool = False
+    def text(self, encoding : str = "utf-8") -> str:
+        return self.content.decode(encoding, errors="replace")
+
+class HttpClient:
+    #A shared aiohttp session with keep-alive pools per host and a timeout per request. GETs go through response_cache.
+    def __init__(self, timeout : float = 10, limit_per_host : int = 8, keepalive_timeout : float = 30):
+        self.timeout = timeout
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.session : Optional[aiohttp.ClientSession] = None
+        self.loop : Optional[asyncio.AbstractEventLoop] = None
+        self.closing : set[asyncio.Future] = set()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self.session is not None and not self.session.closed and self.loop is not loop:
+            self.close_stale_session()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host, keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.loop = loop
+        return self.session
+
+    def close_stale_session(self) -> None:
+        #A session is closed on the loop it was made on if that's still running in another thread. Once that loop has
+        #stopped, closing has nothing left to wait for and can run on this one.
+        if self.loop.is_running():
+            future = asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self.session.close(), self.loop))
+        else:
+            future = asyncio.ensure_future(self.session.close())
+        self.closing.add(future)
+        future.add_done_callback(self.closing.discard)
+        self.session = None
+
+    async def request(self, method : str, url : str, json : Any = None, headers : Optional[dict[str, str]] = None, timeout : Optional[float] = None, max_bytes : Optional[int] = None) -> HttpResponse:
+        client_timeout = aiohttp.ClientTimeout(total=timeout if timeout is not None else self.timeout)
+        async with self.get_session().request(method, url, json=json, headers=headers, timeout=client_timeout) as response:
+            if max_bytes is None:
+                return HttpResponse(str(response.url), response.status, CIMultiDict(response.headers), await response.read())
+            #Stop reading once the cap is hit; the rest of the body is never downloaded.
+            chunks = []
+            size = 0
+            async for chunk in response.content.iter_chunked(65536):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= max_bytes:
+                    break
+            truncated = size >= max_bytes and not response.content.at_eof()
+            return HttpResponse(str(response.url), response.status, CIMultiDict(response.headers), b"".join(chunks)[:max_bytes], truncated)
+
+    async def get(self, url : str, headers : Optional[dict[str, str]] = None, timeout : Optional[float] = None, cache : bool = True, max_bytes : Optional[int] = None) -> HttpResponse:
+        if not cache:
+            return await self.request("GET", url, headers=headers, timeout=timeout, max_bytes=max_bytes)
+        entry = response_cache.get(url)
+        if entry is not None and entry.fresh:
+            return HttpResponse(url, entry.status, CIMultiDict(), entry.value)
+        headers = dict(headers or {})
+        if entry is not None and not entry.negative:
+            if entry.etag is not None:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified is not None:
+                headers["If-Modified-Since"] = entry.last_modified
+        response = await self.request("GET", url, headers=headers, timeout=timeout, max_bytes=max_bytes)
+        cache_control = response.headers.get("Cache-Control")
+        ttl = get_max_age(cache_control)
+        if response.status == 304 and entry is not None:
+            #The entry may have been evicted since it was read; the copy in hand is still valid, so store it again.
+            touched = response_cache.touch(url, ttl)
+            if touched is None:
+                touched = response_cache.put(url, entry.value, entry.status, ttl, entry.etag, entry.last_modified)
+            return HttpResponse(url, touched.status, response.headers, touched.value)
+        if response.truncated or (cache_control is not None and "no-store" in cache_control.lower()):
+            return response
+        if response.status == 200:
+            response_cache.put(url, response.content, response.status, ttl, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        elif response.status in (404, 410):
+            response_cache.put(url, response.content, response.status, negative=True)
+        return response
+
+    async def post(self, url : str, json : Any = None, headers : Optional[dict[str, str]] = None, timeout : Optional[float] = None) -> HttpResponse:
+        return await self.request("POST", url, json=json, headers=headers, timeout=timeout)
+
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+http_client = HttpClient()
@@ -0,0 +1,26 @@
+import importlib
+import logging
+import time
+from types import ModuleType
+from typing import Any, Optional
+
+class LazyModule(ModuleType):
+    #A stand-in for a heavy module, imported the first time one of its attributes is used.
+    def __init__(self, name : str):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+    def _load(self) -> ModuleType:
+        module : Optional[ModuleType] = self.__dict__["_module"]
+        if module is None:
+            start = time.perf_counter()
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_module"] = module
+            logging.info(f"Lazily imported {self.__name__} in {time.perf_counter() - start:.3f}s")
+        return module
+    def __getattr__(self, name : str) -> Any:
+        return getattr(self._load(), name)
+    def __dir__(self):
+        return dir(self._load())
+
+def lazy_import(name : str) -> LazyModule:
+    return LazyModule(name)
@@ -0,0 +1,131 @@
+from __future__ import annotations
+import bisect
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+#Dollars per 1000 prompt and completion tokens, matched on the longest model prefix.
+PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4o": (0.005, 0.015),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+def get_price(model : str) -> Tuple[float, float]:
+    matches = [name for name in PRICES if model.startswith(name)]
+    return PRICES[max(matches, key=len)] if matches else (0.0, 0.0)
+
+class Histogram:
+    def __init__(self, buckets : Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value : float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+Labels = Tuple[str, str]
+
+class LlmMetrics:
+    #Completion metrics per call site and model, rendered in the Prometheus text format and served on `port`.
+    histograms = {
+        "wopr_llm_latency_seconds": ("Completion latency including retries", LATENCY_BUCKETS),
+        "wopr_llm_ttft_seconds": ("Time to the first streamed token", LATENCY_BUCKETS),
+        "wopr_llm_prompt_tokens": ("Prompt tokens per completion", TOKEN_BUCKETS),
+        "wopr_llm_completion_tokens": ("Completion tokens per completion", TOKEN_BUCKETS),
+    }
+    counters = {
+        "wopr_llm_calls_total": "Completions requested",
+        "wopr_llm_retries_total": "Completion attempts that were retried",
+        "wopr_llm_errors_total": "Completions that failed after all retries",
+        "wopr_llm_cost_dollars_total": "Estimated spend",
+    }
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values : Dict[str, Dict[Labels, Histogram]] = {name: {} for name in self.histograms}
+        self.totals : Dict[str, Dict[Labels, float]] = {name: defaultdict(float) for name in self.counters}
+        self.server : Optional[ThreadingHTTPServer] = None
+
+    def observe(self, name : str, call_site : str, model : str, value : float) -> None:
+        with self.lock:
+            histograms = self.values[name]
+            if (call_site, model) not in histograms:
+                histograms[(call_site, model)] = Histogram(self.histograms[name][1])
+            histograms[(call_site, model)].observe(value)
+
+    def increment(self, name : str, call_site : str, model : str, value : float = 1) -> None:
+        with self.lock:
+            self.totals[name][(call_site, model)] += value
+
+    def record(self, call_site : str, model : str, latency : float, prompt_tokens : Optional[int], completion_tokens : Optional[int], retries : int = 0, ttft : Optional[float] = None) -> None:
+        self.increment("wopr_llm_calls_total", call_site, model)
+        self.observe("wopr_llm_latency_seconds", call_site, model, latency)
+        if ttft is not None:
+            self.observe("wopr_llm_ttft_seconds", call_site, model, ttft)
+        if retries > 0:
+            self.increment("wopr_llm_retries_total", call_site, model, retries)
+        if prompt_tokens is not None and completion_tokens is not None:
+            self.observe("wopr_llm_prompt_tokens", call_site, model, prompt_tokens)
+            self.observe("wopr_llm_completion_tokens", call_site, model, completion_tokens)
+            prompt_price, completion_price = get_price(model)
+            self.increment("wopr_llm_cost_dollars_total", call_site, model, (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000)
+
+    def render(self) -> str:
+        lines : List[str] = []
+        def labels(call_site, model, **extra):
+            pairs = dict(call_site=call_site, model=model, **extra)
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs.items()) + "}"
+        with self.lock:
+            for name, (description, buckets) in self.histograms.items():
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+                for (call_site, model), histogram in sorted(self.values[name].items()):
+                    cumulative = 0
+                    for bucket, count in zip(list(buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{labels(call_site, model, le=bucket)} {cumulative}")
+                    lines.append(f"{name}_sum{labels(call_site, model)} {histogram.sum}")
+                    lines.append(f"{name}_count{labels(call_site, model)} {histogram.count}")
+            for name, description in self.counters.items():
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+                for (call_site, model), value in sorted(self.totals[name].items()):
+                    lines.append(f"{name}{labels(call_site, model)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port : int, host : str = "127.0.0.1") -> None:
+        if self.server is not None:
+            return
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="llm-metrics", daemon=True).start()
+        logging.info(f"Serving LLM metrics on http://{host}:{port}/metrics")
+
+    def serve_from_env(self, offset : int = 0) -> None:
+        #Worker processes pass their index as the offset so each gets its own port.
+        port = int(os.environ.get("WOPR-Metrics-Port", "0"))
+        if port > 0:
+            self.serve(port + offset, os.environ.get("WOPR-Metrics-Host", "127.0.0.1"))
+
+metrics = LlmMetrics()
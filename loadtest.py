@@ -0,0 +1,266 @@
+from __future__ import annotations
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
+from aiohttp import web
+from openai import AsyncOpenAI
+#chatgpt builds its clients on import, and no real key is needed
+os.environ.setdefault("OpenAIAPI", "loadtest")
+import chatgpt
+from db import Database
+from discord_handler import DiscordHandler
+from dto import Channel, Guild, Message, User
+from message_handler import MessageHandler
+from sendable import Editable, Sendable
+from tracing import tracer
+
+WORDS = "the of and to in is that for it as was with be by on not he this are or his from at which but have an they you were her she there one all we can".split()
+
+class StubOpenAI:
+    #An OpenAI compatible completions server for load tests. It runs on its own loop in a thread, so it doesn't add
+    #lag to the loop being measured.
+    def __init__(self, latency : float = 0.3, tokens_per_second : float = 50, reply_tokens : int = 60, port : int = 0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.port = port
+        self.requests = 0
+        self.loop : Optional[asyncio.AbstractEventLoop] = None
+        self.runner : Optional[web.AppRunner] = None
+
+    def reply(self) -> List[str]:
+        return [random.choice(WORDS) + " " for _ in range(self.reply_tokens)]
+
+    def classification(self, messages : List[dict[str, Any]]) -> str:
+        intents : List[str] = []
+        for message in messages:
+            content = message.get("content") or ""
+            if 'The "intent" parameter MUST be one of' in content:
+                intents = [line[2:] for line in content.splitlines() if line.startswith("- ")]
+        intent = "None of the above." if "None of the above." in intents else (intents[0] if intents else None)
+        text = messages[-1].get("content", "").replace('"', "'")
+        return f'```yaml\n- original_message: "{text}"\n  message_part: "{text}"\n  intent: "{intent}"\n```'
+
+    def usage(self, messages : List[dict[str, Any]], completion_tokens : int) -> dict[str, int]:
+        prompt_tokens = sum(len(str(message.get("content") or "")) for message in messages) // 4
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    async def completions(self, request : web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        messages = body.get("messages", [])
+        await asyncio.sleep(self.latency)
+        chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"]}
+        if not body.get("stream"):
+            if any("MessageClassification" in (message.get("content") or "") for message in messages):
+                content = self.classification(messages)
+            else:
+                content = "".join(self.reply())
+            tokens = len(content.split())
+            await asyncio.sleep(tokens / self.tokens_per_second)
+            return web.json_response(dict(chunk, object="chat.completion", usage=self.usage(messages, tokens),
+                                          choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}]))
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        async def event(data : Any) -> None:
+            await response.write(b"data: " + json.dumps(data).encode("utf-8") + b"\n\n")
+        tokens = self.reply()
+        for token in tokens:
+            await event(dict(chunk, choices=[{"index": 0, "delta": {"content": token}}]))
+            await asyncio.sleep(1 / self.tokens_per_second)
+        await event(dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if body.get("stream_options", {}).get("include_usage"):
+            await event(dict(chunk, choices=[], usage=self.usage(messages, len(tokens))))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    def start(self) -> str:
+        started = threading.Event()
+        async def serve():
+            app = web.Application(client_max_size=16 * 1024 * 1024)
+            app.router.add_post("/v1/chat/completions", self.completions)
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, "127.0.0.1", self.port)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+            started.set()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="stub-openai", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(serve(), self.loop)
+        started.wait(10)
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def stop(self) -> None:
+        if self.loop is not None and self.runner is not None:
+            asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result(10)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+class RecordingEditable(Editable):
+    def __init__(self, sendable : RecordingSendable, index : int):
+        super().__init__(None)
+        self.sendable = sendable
+        self.index = index
+    async def edit(self, content):
+        self.sendable.record(content)
+        self.sendable.messages[self.index] = content
+    async def delete(self):
+        self.sendable.messages[self.index] = None
+
+class RecordingSendable(Sendable):
+    #Records what would have been sent to Discord and when the first output arrived. Pipes buffer like DiscordSendable's.
+    def __init__(self):
+        self.messages : List[Optional[str]] = []
+        self.first_output : Optional[float] = None
+        self.writes = 0
+    def record(self, content : str) -> None:
+        self.writes += 1
+        if self.first_output is None:
+            self.first_output = time.perf_counter()
+    async def send(self, message : str, view : Any = None) -> Editable:
+        self.record(message)
+        self.messages.append(message)
+        return RecordingEditable(self, len(self.messages) - 1)
+    def get_pipe(self) -> Tuple[Callable[[str], Editable], Callable[[], None]]:
+        editable : Optional[Editable] = None
+        content = ""
+        sent = 0
+        async def pipe(message):
+            nonlocal editable, content, sent
+            content += message
+            if len(content) > sent + 100:
+                sent = len(content)
+                if editable is None:
+                    editable = await self.send(content)
+                else:
+                    await editable.edit(content)
+        async def done():
+            nonlocal editable
+            if content == "":
+                return
+            if editable is None:
+                editable = await self.send(content)
+            else:
+                await editable.edit(content)
+        return pipe, done
+
+class LoopLagMonitor:
+    #Samples how late a sleep on the loop wakes up; anything blocking the loop shows up here.
+    def __init__(self, interval : float = 0.01):
+        self.interval = interval
+        self.samples : List[float] = []
+        self.task : Optional[asyncio.Task] = None
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+@dataclass
+class LoadReport:
+    messages:int = 0
+    errors:int = 0
+    elapsed:float = 0
+    latencies:List[float] = field(default_factory=list)
+    first_outputs:List[float] = field(default_factory=list)
+    lag:List[float] = field(default_factory=list)
+    llm_requests:int = 0
+    def summary(self) -> str:
+        def percentile(values, fraction):
+            if len(values) == 0:
+                return float("nan")
+            values = sorted(values)
+            return values[min(len(values) - 1, int(fraction * len(values)))]
+        def ms(values, fraction):
+            return f"{percentile(values, fraction) * 1000:.0f}ms"
+        lines = [f"{self.messages} messages ({self.errors} failed) in {self.elapsed:.2f}s: {self.messages / self.elapsed:.2f} msgs/sec, {self.llm_requests} LLM requests",
+                 f"latency            p50 {ms(self.latencies, 0.5)}  p99 {ms(self.latencies, 0.99)}  max {ms(self.latencies, 1)}",
+                 f"first output       p50 {ms(self.first_outputs, 0.5)}  p99 {ms(self.first_outputs, 0.99)}",
+                 f"event loop lag     p50 {ms(self.lag, 0.5)}  p99 {ms(self.lag, 0.99)}  max {ms(self.lag, 1)}  mean {statistics.fmean(self.lag) * 1000 if self.lag else float('nan'):.1f}ms"]
+        return "\n".join(lines)
+
+def make_message(user : int, text : str, channel : str = "1") -> Message:
+    return Message(User(str(1000 + user), f"user{user}", f"User {user}", "0", None, False, False), text, Channel(channel), Guild("1", "Load Test"),
+                   [], datetime.now(timezone.utc), random.getrandbits(48), id=os.urandom(16).hex())
+
+async def run_load(handler : MessageHandler, database : Database, users : int = 10, messages_per_user : int = 5, think_time : float = 0.0, coalesce : bool = False) -> LoadReport:
+    #Each simulated user sends a message, waits for the handler to finish with it, thinks, and sends the next.
+    report = LoadReport()
+    monitor = LoopLagMonitor()
+    async def user(index : int) -> None:
+        generator = random.Random(index)
+        for _ in range(messages_per_user):
+            sendable = RecordingSendable()
+            message = make_message(index, " ".join(generator.choice(WORDS) for _ in range(generator.randint(5, 25))) + "?")
+            start = time.perf_counter()
+            try:
+                if coalesce and isinstance(handler, DiscordHandler):
+                    await handler.coalescer.submit(message, database, sendable)
+                else:
+                    await handler.handle_message(message, database, sendable)
+            except Exception:
+                report.errors += 1
+                logging.exception("Message failed")
+            report.messages += 1
+            report.latencies.append(time.perf_counter() - start)
+            if sendable.first_output is not None:
+                report.first_outputs.append(sendable.first_output - start)
+            if think_time > 0:
+                await asyncio.sleep(generator.expovariate(1 / think_time))
+    monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(user(index) for index in range(users)))
+    report.elapsed = time.perf_counter() - start
+    await monitor.stop()
+    report.lag = monitor.samples
+    return report
+
+async def main(arguments : argparse.Namespace) -> None:
+    stub = StubOpenAI(arguments.latency, arguments.tokens_per_second, arguments.reply_tokens)
+    chatgpt.aclient = AsyncOpenAI(api_key="loadtest", base_url=stub.start(), max_retries=0)
+    with tempfile.TemporaryDirectory(prefix="wopr-loadtest-") as scratch:
+        tracer.path = os.path.join(scratch, "traces.json") if arguments.trace else None
+        if not arguments.trace:
+            tracer.slow_threshold = float("inf")
+        database = Database(os.path.join(scratch, "db.json"))
+        handler = DiscordHandler() if arguments.coalesce else MessageHandler()
+        report = await run_load(handler, database, arguments.users, arguments.messages, arguments.think_time, arguments.coalesce)
+        report.llm_requests = stub.requests
+        print(report.summary())
+        if arguments.trace:
+            print("Slowest traces:")
+            for trace in tracer.slow_traces()[:5]:
+                print(f"  {trace.root.duration * 1000:.0f}ms: {trace.summary()}")
+    stub.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive MessageHandler with simulated users against a local stub of the OpenAI API.")
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--messages", type=int, default=5, help="messages each user sends")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean seconds a user waits between messages")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the stub starts answering")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="stub generation rate")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="words in each stub reply")
+    parser.add_argument("--coalesce", action="store_true", help="go through DiscordHandler's message coalescer")
+    parser.add_argument("--trace", action="store_true", help="record traces and show the slowest")
+    parser.add_argument("--log-level", default="WARNING")
+    arguments = parser.parse_args()
+    logging.basicConfig(level=arguments.log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main(arguments))
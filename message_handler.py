@@ -1,13 +1,18 @@
+import asyncio
 from dataclasses import dataclass, asdict
 import logging
-from typing import Any, List, Protocol
+import os
+from typing import Any, List, Protocol, Tuple
 from action import ConversationChangeException, ConversationCompletionAction
 from db import Database, UserUnion
-import docker_runner
+import docker_runner #Registers the docker tool executor
 from dto import Function, FunctionParameter, FunctionParameters, Knowledge, Message, Knowledge, Tool, ToolDefinition
 from intent import CreateToolIntent, InquiryIntent, Intent, RememberIntent, TopicChangeIntent
 from intent_classifier import IntentClassifier
 from sendable import Sendable
+from tool_cache import ToolResultCache
+from tool_executor import select_executor
+from tracing import tracer
 import chatgpt
 
 
@@ -15,10 +20,39 @@ class CustomHandler(Protocol):
     async def __call__(self, message: Message, database: Database, sendable: Sendable) -> None:
         ...
     
+class ToolOutputStream:
+    #Shows a tool's output while it runs, up to `max_bytes`; the completion still gets the executor's capture.
+    def __init__(self, name : str, sendable : Sendable, max_bytes : int = 1500):
+        self.name = name
+        self.sendable = sendable
+        self.max_bytes = max_bytes
+        self.sent = 0
+        self.pipe = None
+        self.done = None
+    async def write(self, text : str) -> None:
+        if self.sent > self.max_bytes:
+            return
+        if self.pipe is None:
+            self.pipe, self.done = self.sendable.get_pipe()
+            await self.pipe(f"`{self.name}`\n```\n")
+        data = text.encode("utf-8")
+        if self.sent + len(data) > self.max_bytes:
+            text = data[:self.max_bytes - self.sent].decode("utf-8", errors="ignore") + "\n[output truncated]"
+        self.sent += len(data)
+        await self.pipe(text)
+    async def close(self) -> None:
+        if self.pipe is not None:
+            await self.pipe("\n```")
+            await self.done()
+
 class MessageHandler:
     def __init__(self):
         self.custom_handlers: dict[str, CustomHandler] = {}
         self.intent_classifier = IntentClassifier()
+        self.tool_timeout = float(os.environ.get("WOPR-Tool-Timeout", "60"))
+        self.message_timeout = float(os.environ.get("WOPR-Tool-Message-Timeout", "90"))
+        self.tool_cache = ToolResultCache.from_env()
+        self.stream_bytes = int(os.environ.get("WOPR-Tool-Stream-Bytes", "1500"))
 
     async def add_custom_handler(self, user:UserUnion, handler):
         self.custom_handlers[str(user.id)] = handler
@@ -44,6 +78,7 @@ class MessageHandler:
         for dependency in definition.pip_packages:
             tool_spec += f"{dependency}, "
         tool_spec = tool_spec[:-2] + "\n"
+        tool_spec += f"Tool Results Cacheable: {'Yes' if definition.cacheable else 'No'}\n"
         tool_spec += f"Tool Code:\n```python\n{definition.python}\n```\n"
         tool_spec += f"Tool Example Invocation:\n```python\n{definition.example_invocation}\n```\n"
         return tool_spec, definition  
@@ -53,41 +88,88 @@ class MessageHandler:
             self.function = function
             self.function_parameters = function_parameters
             
+    async def run_tool(self, tools:List[ToolDefinition], tool_call: ToolCall, message : Message, database : Database, sendable : Sendable) -> Tuple[List[dict[str, Any]], List[Intent]]:
+        with tracer.span("tool", tool=tool_call.function):
+            return await self.call_tool(tools, tool_call, message, database, sendable)
+
+    async def call_tool(self, tools:List[ToolDefinition], tool_call: ToolCall, message : Message, database : Database, sendable : Sendable) -> Tuple[List[dict[str, Any]], List[Intent]]:
+        tool_call_results = []
+        intents = []
+        if tool_call.function == "create_tool":
+            #create the tool
+            tool_spec, definition = await self.create_tool(tool_call.function_parameters["description"])
+            tool_call_results.append({"role": "function", "name": tool_call.function, "content": tool_spec, "tool": definition})
+            intents.append(CreateToolIntent())
+            logging.info(f"Created tool {definition.name}")
+        elif tool_call.function == "remember":
+            key = tool_call.function_parameters["knowledge_key"]
+            description = tool_call.function_parameters["description"]
+            value = tool_call.function_parameters["value"]
+            database.set_knowledge(message.user, key, Knowledge(description, value))
+            tool_call_results.append({"role": "function", "name": tool_call.function, "content": tool_call.function_parameters["appropriate_response"]})
+            intents.append(InquiryIntent())
+            logging.info(f"Remembered {key} as {value}")
+        elif tool_call.function == "forget":
+            key = tool_call.function_parameters["knowledge_key"]
+            database.delete_knowledge(message.user, key)
+            tool_call_results.append({"role": "function", "name": tool_call.function, "content": tool_call.function_parameters["appropriate_response"]})
+            intents.append(InquiryIntent())
+            logging.info(f"Forgot {key}")
+        else:
+            for tool in tools:
+                if tool.tool.function.name == tool_call.function:
+                    code = tool.getCode(tool_call.function_parameters)
+                    result = self.tool_cache.get(code, tool.pip_packages) if tool.cacheable else None
+                    tracer.tag(cached=result is not None)
+                    if result is None:
+                        executor = select_executor(tool)
+                        tracer.tag(executor=executor.name)
+                        stream = ToolOutputStream(tool_call.function, sendable, self.stream_bytes)
+                        try:
+                            script_result = await executor.run(code, tool.pip_packages, timeout=self.tool_timeout, on_output=stream.write)
+                        finally:
+                            await stream.close()
+                        result = script_result.output
+                        if tool.cacheable and script_result.ok:
+                            self.tool_cache.add(code, tool.pip_packages, result)
+                    tool_call_results.append({"role": "function", "name": tool_call.function, "content": result})
+                    logging.info(f"Tool call {tool_call.function} returned {result}")
+            intents.append(InquiryIntent())
+        return tool_call_results, intents
+
     async def run_tools(self, tools:List[ToolDefinition], tool_calls: List[ToolCall], message : Message, database : Database, sendable : Sendable) -> List[dict[str, Any]]:
+        #Tool calls run concurrently, each under tool_timeout and all of them under message_timeout. Tools that don't
+        #finish in time are cancelled, which removes their container, and report the timeout as their result.
         tool_call_results = []
         intents = []
-        for tool_call in tool_calls:
-            if tool_call.function == "create_tool":
-                #create the tool
-                tool_spec, definition = await self.create_tool(tool_call.function_parameters["description"])
-                tool_call_results.append({"role": "function", "name": tool_call.function, "content": tool_spec, "tool": definition})
-                intents.append(CreateToolIntent())
-                logging.info(f"Created tool {definition.name}")
-            elif tool_call.function == "remember":
-                key = tool_call.function_parameters["knowledge_key"]
-                description = tool_call.function_parameters["description"]
-                value = tool_call.function_parameters["value"]
-                database.set_knowledge(message.user, key, Knowledge(description, value))
-                tool_call_results.append({"role": "function", "name": tool_call.function, "content": tool_call.function_parameters["appropriate_response"]})
+        if len(tool_calls) == 0:
+            return tool_call_results, intents
+        tasks = [asyncio.create_task(asyncio.wait_for(self.run_tool(tools, tool_call, message, database, sendable), self.tool_timeout)) for tool_call in tool_calls]
+        _, pending = await asyncio.wait(tasks, timeout=self.message_timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for tool_call, task in zip(tool_calls, tasks):
+            if task.cancelled() or isinstance(task.exception(), asyncio.TimeoutError):
+                logging.warning(f"Tool call {tool_call.function} timed out")
+                tool_call_results.append({"role": "function", "name": tool_call.function, "content": "The tool call timed out without a result."})
                 intents.append(InquiryIntent())
-                logging.info(f"Remembered {key} as {value}")
-            elif tool_call.function == "forget":
-                key = tool_call.function_parameters["knowledge_key"]
-                database.delete_knowledge(message.user, key)
-                tool_call_results.append({"role": "function", "name": tool_call.function, "content": tool_call.function_parameters["appropriate_response"]})
+            elif task.exception() is not None:
+                logging.error(f"Tool call {tool_call.function} failed", exc_info=task.exception())
+                tool_call_results.append({"role": "function", "name": tool_call.function, "content": f"The tool call failed: {task.exception()!r}"})
                 intents.append(InquiryIntent())
-                logging.info(f"Forgot {key}")
             else:
-                for tool in tools:
-                    if tool.tool.function.name == tool_call.function:
-                        result = await docker_runner.run_python_script(tool.getCode(tool_call.function_parameters), tool.pip_packages)
-                        tool_call_results.append({"role": "function", "name": tool_call.function, "content": result})
-                        logging.info(f"Tool call {tool_call.function} returned {result}")
-                intents.append(InquiryIntent())
+                results, more_intents = task.result()
+                tool_call_results.extend(results)
+                intents.extend(more_intents)
         return tool_call_results, intents
             
         
     async def handle_message(self, message: Message, database: Database, sendable: Sendable):
+        with tracer.span("message", user=str(message.user.id), guild=message.guild.id if message.guild is not None else None):
+            await self.process_message(message, database, sendable)
+
+    async def process_message(self, message: Message, database: Database, sendable: Sendable):
         if str(message.user.id) in self.custom_handlers:
             await self.custom_handlers[str(message.user.id)](message, database, sendable)
             del self.custom_handlers[str(message.user.id)]
@@ -104,7 +186,8 @@ class MessageHandler:
         tool_specs = [{"type":"function", "function":asdict(tool.tool.function)} for tool in tools]
         logging.debug("Tool specs: " + str([tool.name for tool in tools]))
         tool_call_results = []
-        intents, tool_calls, classifications = await self.intent_classifier.classify_intent(message, Intent.__subclasses__(), database, tools=tool_specs)
+        with tracer.span("classify_intent"):
+            intents, tool_calls, classifications = await self.intent_classifier.classify_intent(message, Intent.__subclasses__(), database, tools=tool_specs)
         my_tool_calls = []
         if classifications is not None:
             #check for tools
@@ -119,9 +202,11 @@ class MessageHandler:
                 tool_call.function.name = tool_call.function.name.replace("functions.", "")
                 logging.info("Tool call: " + str(tool_call.function.name) + " " + str(tool_call.function.arguments))
                 my_tool_calls.append(self.ToolCall(tool_call.function.name, tool_call.function.arguments))
-        tool_call_results, more_intents = await self.run_tools(tools, my_tool_calls, message, database, sendable)
+        with tracer.span("run_tools", tools=[tool_call.function for tool_call in my_tool_calls]):
+            tool_call_results, more_intents = await self.run_tools(tools, my_tool_calls, message, database, sendable)
         if intents is None or len(intents) == 0:
             intents = more_intents
+        tracer.tag_trace(intents=[type(intent).__name__ for intent in intents])
         while(len(intents) > 0): #No for loop here, because we might change state in the middle of the loop
             intent = intents.pop(0)
             logging.info("Handling intent: " + str(intent))
@@ -130,7 +215,8 @@ class MessageHandler:
                 action = actions.pop(0) 
                 logging.info("Handling action: " + str(action))
                 try:
-                    await action(message, database, sendable, tool_call_results)
+                    with tracer.span("action", action=action.name, intent=type(intent).__name__):
+                        await action(message, database, sendable, tool_call_results)
                 except ConversationChangeException:
                     message.text = await chatgpt.remove_change_of_topic(message.text)
                     await self.handle_message(message, database, sendable)
@@ -0,0 +1,282 @@
+from __future__ import annotations
+import asyncio
+import dataclasses
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+from uuid import uuid4
+import discord
+import jsonpickle
+from action import CreateToolButton
+from coalescer import MessageCoalescer
+from db import Database
+from discord_handler import DiscordSendable, DiscordSendableType
+from dto import Message
+from sendable import Editable, Sendable
+
+#Frames are newline delimited JSON. Tool output can be large, so raise the default 64k line limit.
+STREAM_LIMIT = 2**24
+
+async def write_frame(writer : asyncio.StreamWriter, frame : dict[str, Any]) -> None:
+    writer.write(json.dumps(frame).encode("utf-8") + b"\n")
+    await writer.drain()
+
+async def read_frame(reader : asyncio.StreamReader) -> Optional[dict[str, Any]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+def encode_message(message : Message) -> str:
+    #discord.Asset carries the connection state, which can't leave the gateway process.
+    wire = dataclasses.replace(message, user=dataclasses.replace(message.user, avatar=None))
+    return jsonpickle.encode(wire)
+
+def decode_message(payload : str) -> Message:
+    return jsonpickle.decode(payload)
+
+def encode_view(view : Any) -> Optional[dict[str, str]]:
+    if view is None:
+        return None
+    if isinstance(view, CreateToolButton):
+        return {"type": "create_tool", "tool_spec": jsonpickle.encode(view.tool_spec)}
+    raise ValueError("Cannot send view across the queue: " + type(view).__name__)
+
+def decode_view(view : Optional[dict[str, str]], database : Database) -> Any:
+    if view is None:
+        return None
+    if view["type"] == "create_tool":
+        return CreateToolButton(jsonpickle.decode(view["tool_spec"]), database)
+    raise ValueError("Unknown view type: " + view["type"])
+
+class QueueEditable(Editable):
+    def __init__(self, sendable : QueueSendable, handle : str):
+        super().__init__(None)
+        self.sendable = sendable
+        self.handle = handle
+    async def edit(self, content):
+        await self.sendable.emit({"type": "edit", "handle": self.handle, "content": content})
+    async def delete(self):
+        await self.sendable.emit({"type": "delete", "handle": self.handle})
+
+class QueueSendable(Sendable):
+    #Worker side stand-in for the gateway's DiscordSendable; every call becomes a frame tagged with the job id.
+    def __init__(self, job : str, writer : asyncio.StreamWriter, lock : asyncio.Lock):
+        self.job = job
+        self.writer = writer
+        self.lock = lock
+    async def emit(self, frame : dict[str, Any]) -> None:
+        frame["job"] = self.job
+        async with self.lock:
+            await write_frame(self.writer, frame)
+    async def send(self, message : str, view : Any = None) -> Editable:
+        handle = uuid4().hex
+        await self.emit({"type": "send", "handle": handle, "content": message, "view": encode_view(view)})
+        return QueueEditable(self, handle)
+    def get_pipe(self) -> Tuple[Callable[[str], Editable], Callable[[], None]]:
+        pipe_id = uuid4().hex
+        async def pipe(message):
+            await self.emit({"type": "pipe", "pipe": pipe_id, "content": message})
+        async def done():
+            await self.emit({"type": "done", "pipe": pipe_id})
+        return pipe, done
+
+class Job:
+    def __init__(self, job_id : str, sendable : Sendable):
+        self.id = job_id
+        self.sendable = sendable
+        self.events : asyncio.Queue = asyncio.Queue()
+        self.editables : Dict[str, Editable] = {}
+        self.pipes : Dict[str, Tuple[Callable, Callable]] = {}
+
+class WorkerConnection:
+    def __init__(self, index : int, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        self.index = index
+        self.reader = reader
+        self.writer = writer
+        self.jobs : Dict[str, Job] = {}
+        self.lock = asyncio.Lock()
+
+class GatewayQueue:
+    #Gateway side of the worker pool: messages go to workers over a unix socket, sharded by user, and their reply
+    #frames are replayed against the real Discord sendables.
+    def __init__(self, database : Database, workers : int = 2, socket_path : Optional[str] = None):
+        self.database = database
+        self.workers = workers
+        self.socket_path = socket_path or os.path.join(tempfile.gettempdir(), "wopr-" + uuid4().hex[:8] + ".sock")
+        self.connections : Dict[int, WorkerConnection] = {}
+        self.processes : Dict[int, asyncio.subprocess.Process] = {}
+        self.server : Optional[asyncio.AbstractServer] = None
+        self.supervisor : Optional[asyncio.Task] = None
+        self.handlers : set[asyncio.Task] = set()
+        #How long a message waits for its worker to (re)connect before the user is told to try again.
+        self.connect_timeout = float(os.environ.get("WOPR-Worker-Connect-Timeout", "30"))
+        self.coalescer = MessageCoalescer.from_env(self.submit)
+        #When each user's last prefetch was asked for, so typing events within the prefetch TTL aren't forwarded.
+        self.prefetched_at : Dict[str, float] = {}
+        database.invalidation_listeners.append(self.invalidate)
+
+    async def start(self) -> None:
+        if self.server is not None:
+            return
+        self.server = await asyncio.start_unix_server(self.on_worker_connected, path=self.socket_path, limit=STREAM_LIMIT)
+        for index in range(self.workers):
+            await self.spawn_worker(index)
+        self.supervisor = asyncio.create_task(self.supervise())
+        logging.info(f"Gateway queue listening on {self.socket_path} with {self.workers} workers")
+
+    async def stop(self) -> None:
+        if self.supervisor is not None:
+            self.supervisor.cancel()
+            await asyncio.gather(self.supervisor, return_exceptions=True)
+            self.supervisor = None
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.terminate()
+        server = self.server
+        self.server = None
+        if server is not None:
+            server.close()
+        #Connection handlers run until their worker hangs up; end them here (closing their writers) so nothing is left pending.
+        for handler in self.handlers:
+            handler.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        if server is not None:
+            await server.wait_closed()
+        for process in self.processes.values():
+            try:
+                await asyncio.wait_for(process.wait(), 5)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    async def spawn_worker(self, index : int) -> None:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+        self.processes[index] = await asyncio.create_subprocess_exec(sys.executable, script, self.socket_path, self.database.db_path, str(index))
+
+    async def supervise(self) -> None:
+        while True:
+            for index, process in list(self.processes.items()):
+                if process.returncode is not None:
+                    logging.warning(f"Worker {index} exited with {process.returncode}, restarting")
+                    await self.spawn_worker(index)
+            await asyncio.sleep(1)
+
+    async def on_worker_connected(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        hello = await read_frame(reader)
+        if hello is None or hello.get("type") != "hello":
+            writer.close()
+            return
+        connection = WorkerConnection(hello["worker"], reader, writer)
+        self.connections[connection.index] = connection
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        logging.info(f"Worker {connection.index} connected")
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                job = connection.jobs.get(frame["job"])
+                if job is None:
+                    continue
+                job.events.put_nowait(frame)
+        except asyncio.CancelledError:
+            #Cancelled by stop(); the stream server logs handlers that end cancelled as errors.
+            pass
+        finally:
+            self.handlers.discard(handler)
+            writer.close()
+            if self.connections.get(connection.index) is connection:
+                del self.connections[connection.index]
+            for job in connection.jobs.values():
+                job.events.put_nowait({"type": "finished", "error": "worker disconnected"})
+            logging.warning(f"Worker {connection.index} disconnected")
+
+    def shard(self, message : Message) -> int:
+        return int(message.user.id) % self.workers
+
+    async def prefetch(self, user : Any) -> None:
+        connection = self.connections.get(int(user.id) % self.workers)
+        if connection is None:
+            return
+        now = time.monotonic()
+        if now - self.prefetched_at.get(str(user.id), -math.inf) < self.database.prefetch_ttl:
+            return
+        if len(self.prefetched_at) > 4096:
+            self.prefetched_at = {user_id: at for user_id, at in self.prefetched_at.items() if now - at < self.database.prefetch_ttl}
+        self.prefetched_at[str(user.id)] = now
+        async with connection.lock:
+            await write_frame(connection.writer, {"type": "prefetch", "user_id": str(user.id)})
+
+    def invalidate(self, user_id : str) -> None:
+        #The gateway writes some user state itself (persona commands, tool buttons), which the owning worker may have
+        #prefetched. Written without waiting for the lock so it's queued ahead of any job sent for the user after
+        #the write; a frame goes out in a single write, so it can't interleave with another.
+        self.prefetched_at.pop(user_id, None)
+        connection = self.connections.get(int(user_id) % self.workers)
+        if connection is not None:
+            connection.writer.write(json.dumps({"type": "invalidate", "user_id": user_id}).encode("utf-8") + b"\n")
+
+    async def submit(self, message : Message, sendable : Sendable) -> None:
+        index = self.shard(message)
+        deadline = time.monotonic() + self.connect_timeout
+        while index not in self.connections:
+            #The worker is (re)starting, hold the message until it connects, unless it doesn't come back.
+            if self.server is None or time.monotonic() > deadline:
+                logging.error(f"Worker {index} didn't connect within {self.connect_timeout}s, dropping message {message.id}")
+                await sendable.send("Sorry, I can't answer right now. Please try again in a minute.")
+                return
+            await asyncio.sleep(0.1)
+        connection = self.connections[index]
+        job = Job(uuid4().hex, sendable)
+        connection.jobs[job.id] = job
+        try:
+            async with connection.lock:
+                await write_frame(connection.writer, {"type": "job", "job": job.id, "message": encode_message(message)})
+            await self.replay(job)
+        finally:
+            connection.jobs.pop(job.id, None)
+
+    async def replay(self, job : Job) -> None:
+        while True:
+            frame = await job.events.get()
+            kind = frame["type"]
+            try:
+                if kind == "finished":
+                    if frame.get("error") is not None:
+                        logging.error(f"Job {job.id} failed: {frame['error']}")
+                    return
+                elif kind == "send":
+                    job.editables[frame["handle"]] = await job.sendable.send(frame["content"], view=decode_view(frame["view"], self.database))
+                elif kind == "edit":
+                    await job.editables[frame["handle"]].edit(frame["content"])
+                elif kind == "delete":
+                    await job.editables[frame["handle"]].delete()
+                elif kind == "pipe":
+                    if frame["pipe"] not in job.pipes:
+                        job.pipes[frame["pipe"]] = job.sendable.get_pipe()
+                    await job.pipes[frame["pipe"]][0](frame["content"])
+                elif kind == "done":
+                    if frame["pipe"] not in job.pipes:
+                        job.pipes[frame["pipe"]] = job.sendable.get_pipe()
+                    await job.pipes[frame["pipe"]][1]()
+            except Exception as e:
+                logging.exception(f"Failed to replay {kind} for job {job.id}: {e}")
+
+    async def submit_discord_message(self, message : discord.Message, sendable : DiscordSendableType) -> None:
+        if isinstance(sendable, discord.Interaction):
+            try:
+                await sendable.response.defer()
+                await sendable.delete_original_response()
+            except Exception:
+                pass
+            return await self.submit(Message.from_message(message), DiscordSendable(sendable.followup))
+        return await self.coalescer.submit(Message.from_message(message), DiscordSendable(sendable))
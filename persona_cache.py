@@ -0,0 +1,50 @@
+from __future__ import annotations
+import hashlib
+import logging
+import os
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+from persona_registry import Persona
+
+class PersonaResponseCache:
+    #Persona openers don't depend on the user, so up to `variations` completions per persona are kept for `ttl`
+    #seconds and served at random. Keyed on the prompt text, so editing a persona invalidates them.
+    def __init__(self, ttl : float = 3600, variations : int = 3):
+        self.ttl = ttl
+        self.variations = variations
+        self.openers : Dict[str, List[Tuple[float, str]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_env() -> PersonaResponseCache:
+        return PersonaResponseCache(float(os.environ.get("WOPR-Persona-Cache-TTL", "3600")), int(os.environ.get("WOPR-Persona-Cache-Variations", "3")))
+
+    def key(self, persona : Persona) -> str:
+        return hashlib.sha256((persona.system + "\0" + persona.user).encode("utf-8")).hexdigest()
+
+    def fresh(self, persona : Persona) -> List[str]:
+        now = time.monotonic()
+        key = self.key(persona)
+        entries = [(created, text) for created, text in self.openers.get(key, []) if now - created < self.ttl]
+        self.openers[key] = entries
+        return [text for _, text in entries]
+
+    def get(self, persona : Persona) -> Optional[str]:
+        if self.variations <= 0:
+            return None
+        openers = self.fresh(persona)
+        if len(openers) < self.variations:
+            self.misses += 1
+            return None
+        self.hits += 1
+        logging.info(f"Persona opener cache hit for {persona.command} ({self.hits} hits, {self.misses} misses)")
+        return random.choice(openers)
+
+    def add(self, persona : Persona, completion : str) -> None:
+        if self.variations <= 0 or completion is None or completion.strip() == "":
+            return
+        openers = self.fresh(persona)
+        if len(openers) < self.variations:
+            self.openers[self.key(persona)].append((time.monotonic(), completion))
@@ -0,0 +1,128 @@
+from __future__ import annotations
+import asyncio
+from dataclasses import dataclass, field
+import json
+import logging
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import discord
+from discord import app_commands
+from command_sync import sync_if_changed
+from dto import Conversation
+
+COMMAND_NAME = re.compile(r"^[-_a-z0-9]{1,32}$")
+REQUIRED_FIELDS = ["name", "command", "description", "system", "user"]
+
+@dataclass(frozen=True)
+class Persona:
+    name:str
+    command:str
+    description:str
+    system:str
+    user:str
+    base:Conversation = field(init=False, repr=False, compare=False)
+    def __post_init__(self):
+        base = Conversation.new_conversation()
+        base.set_system("system", self.system)
+        object.__setattr__(self, "base", base)
+    def new_conversation(self) -> Conversation:
+        return self.base.fork()
+
+class PersonaValidationError(ValueError):
+    pass
+
+def validate_personas(commands : Any) -> Dict[str, Persona]:
+    if not isinstance(commands, list):
+        raise PersonaValidationError("commands.json must be a list of personas.")
+    personas : Dict[str, Persona] = {}
+    for i, command in enumerate(commands):
+        if not isinstance(command, dict):
+            raise PersonaValidationError(f"Persona {i} is not an object.")
+        for field in REQUIRED_FIELDS:
+            if not isinstance(command.get(field), str) or command[field] == "":
+                raise PersonaValidationError(f"Persona {i} is missing \"{field}\".")
+        if not COMMAND_NAME.match(command["command"]):
+            raise PersonaValidationError(f"Persona {i} has an invalid command name: {command['command']}")
+        if len(command["description"]) > 100:
+            raise PersonaValidationError(f"Persona {command['command']} has a description longer than 100 characters.")
+        if command["command"] in personas:
+            raise PersonaValidationError(f"Persona {command['command']} is defined more than once.")
+        personas[command["command"]] = Persona(**{field: command[field] for field in REQUIRED_FIELDS})
+    return personas
+
+PersonaCallback = Callable[[discord.Interaction, Persona], Awaitable[None]]
+
+class PersonaRegistry:
+    #Keeps the app_commands in sync with commands.json without a restart. Callbacks look their persona up when
+    #invoked, and only added, removed or re-described commands trigger a sync.
+    def __init__(self, tree : app_commands.CommandTree, callback : PersonaCallback, path : str = "commands.json", poll_interval : float = 2.0):
+        self.tree = tree
+        self.callback = callback
+        self.path = path
+        self.poll_interval = poll_interval
+        self.personas : Dict[str, Persona] = {}
+        self.raw : List[dict[str, str]] = []
+        self.mtime : Optional[float] = None
+        self.watcher : Optional[asyncio.Task] = None
+
+    def get(self, command : str) -> Optional[Persona]:
+        return self.personas.get(command)
+
+    def make_callback(self, command : str):
+        async def interaction(interaction : discord.Interaction):
+            persona = self.get(command)
+            if persona is None:
+                await interaction.response.send_message("That persona no longer exists.", ephemeral=True)
+                return
+            await self.callback(interaction, persona)
+        return interaction
+
+    def read(self) -> Dict[str, Persona]:
+        with open(self.path, "r") as file:
+            raw = json.load(file)
+        personas = validate_personas(raw)
+        self.raw = raw
+        return personas
+
+    def apply(self, personas : Dict[str, Persona]) -> bool:
+        added = [name for name in personas if name not in self.personas]
+        removed = [name for name in self.personas if name not in personas]
+        redescribed = [name for name in personas if name in self.personas and personas[name].description != self.personas[name].description]
+        changed = [name for name in personas if name in self.personas and personas[name] != self.personas[name] and name not in redescribed]
+        for name in removed + redescribed:
+            self.tree.remove_command(name)
+        for name in added + redescribed:
+            self.tree.add_command(app_commands.Command(name=name, description=personas[name].description, callback=self.make_callback(name)))
+        self.personas = personas
+        if len(added + removed + redescribed + changed) > 0:
+            logging.info(f"Personas added: {added}, removed: {removed}, redescribed: {redescribed}, prompt changes: {changed}")
+        return len(added + removed + redescribed) > 0
+
+    def load(self) -> None:
+        self.mtime = os.stat(self.path).st_mtime
+        self.apply(self.read())
+
+    async def reload(self) -> None:
+        try:
+            personas = self.read()
+        except (OSError, ValueError) as e:
+            logging.error(f"Not reloading {self.path}: {e}")
+            return
+        if self.apply(personas):
+            await sync_if_changed(self.tree, self.raw)
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                continue
+            if mtime != self.mtime:
+                self.mtime = mtime
+                await self.reload()
+
+    def start(self) -> None:
+        if self.watcher is None:
+            self.watcher = asyncio.create_task(self.watch())
@@ -0,0 +1,131 @@
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+@dataclass
+class CacheEntry:
+    key:str
+    value:bytes
+    status:int
+    expires:float
+    etag:Optional[str] = None
+    last_modified:Optional[str] = None
+    negative:bool = False
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.expires
+
+class ResponseCache:
+    #A size bounded, on disk LRU of responses shared by every DataSource, with ETag and Last-Modified kept for
+    #revalidation and misses cached as negative entries.
+    def __init__(self, path : str = "http_cache.sqlite", max_bytes : int = 64 * 1024 * 1024, default_ttl : float = 3600, negative_ttl : float = 300, memory_entries : int = 256):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.memory_entries = memory_entries
+        self.memory : OrderedDict[str, CacheEntry] = OrderedDict()
+        #Access times of memory hits not yet written to sqlite, which evict() orders by.
+        self.accessed : Dict[str, float] = {}
+        self.connection : Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.size : Optional[int] = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB, status INTEGER, expires REAL, etag TEXT, last_modified TEXT, negative INTEGER, size INTEGER, accessed REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self.connection
+
+    def remember(self, entry : CacheEntry) -> None:
+        self.memory[entry.key] = entry
+        self.memory.move_to_end(entry.key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key : str) -> Optional[CacheEntry]:
+        #Returns stale entries too, so the caller can revalidate them.
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.accessed[key] = time.time()
+                if len(self.accessed) >= 64:
+                    self.flush_accessed()
+                return entry
+            connection = self.connect()
+            row = connection.execute("SELECT value, status, expires, etag, last_modified, negative FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            entry = CacheEntry(key, row[0], row[1], row[2], row[3], row[4], bool(row[5]))
+            self.remember(entry)
+            return entry
+
+    def put(self, key : str, value : bytes, status : int = 200, ttl : Optional[float] = None, etag : Optional[str] = None, last_modified : Optional[str] = None, negative : bool = False) -> CacheEntry:
+        if ttl is None:
+            ttl = self.negative_ttl if negative else self.default_ttl
+        entry = CacheEntry(key, value, status, time.time() + ttl, etag, last_modified, negative)
+        with self.lock:
+            connection = self.connect()
+            old = connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (key, value, status, entry.expires, etag, last_modified, int(negative), len(value), time.time()))
+            self.size += len(value) - (old[0] if old is not None else 0)
+            self.accessed.pop(key, None)
+            self.remember(entry)
+            self.evict()
+        return entry
+
+    def touch(self, key : str, ttl : Optional[float] = None) -> Optional[CacheEntry]:
+        entry = self.get(key)
+        if entry is None:
+            return None
+        entry.expires = time.time() + (ttl if ttl is not None else self.default_ttl)
+        with self.lock:
+            self.connect().execute("UPDATE responses SET expires = ? WHERE key = ?", (entry.expires, key))
+        return entry
+
+    def flush_accessed(self) -> None:
+        if len(self.accessed) > 0:
+            self.connect().executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(accessed, key) for key, accessed in self.accessed.items()])
+            self.accessed.clear()
+
+    def evict(self) -> None:
+        connection = self.connect()
+        if self.size > self.max_bytes:
+            self.flush_accessed()
+        while self.size > self.max_bytes:
+            rows = connection.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 32").fetchall()
+            if len(rows) == 0:
+                break
+            for key, size in rows:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.memory.pop(key, None)
+                self.accessed.pop(key, None)
+                self.size -= size
+                if self.size <= self.max_bytes:
+                    break
+
+def get_max_age(cache_control : Optional[str]) -> Optional[float]:
+    if cache_control is None:
+        return None
+    for directive in cache_control.split(","):
+        directive = directive.strip().lower()
+        if directive == "no-cache":
+            return 0
+        if directive.startswith("max-age="):
+            try:
+                return float(directive[len("max-age="):])
+            except ValueError:
+                return None
+    return None
+
+response_cache = ResponseCache(os.environ.get("WOPR-HTTP-Cache", "http_cache.sqlite"))
@@ -1,12 +1,14 @@
 from abc import abstractmethod
 from typing import Callable, Any, Tuple
+from tracing import tracer
 
 
 class Editable():
     def __init__(self, editable: Any):
         self.editable = editable
     async def edit(self, content):
-        await self.editable.edit(content=content)
+        with tracer.span("discord.edit", root=False):
+            await self.editable.edit(content=content)
     async def delete(self):
         await self.editable.delete_original_message()
 
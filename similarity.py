@@ -0,0 +1,180 @@
+from __future__ import annotations
+import re
+import time
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+import zlib
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+scipy_sparse = lazy_import("scipy.sparse")
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+#Same as keeping c.isalnum() or c.isspace(): \w is isalnum() plus the underscore.
+PUNCTUATION = re.compile(r"[^\w\s]|_")
+
+def normalize(text : str) -> str:
+    # Remove unnecessary characters and convert to lowercase
+    text = PUNCTUATION.sub("", text).lower().strip()
+    # Remove common prefixes
+    if text.startswith("the"):
+        text = text[4:]
+    return text
+
+def get_count_matrix(texts : List[str]) -> Tuple[scipy_sparse.csr_matrix, List[str]]:
+    #Word counts of every text in one pass, as a sparse texts x vocabulary matrix, along with the vocabulary.
+    vocabulary : Dict[str, int] = {}
+    columns : List[int] = []
+    pointers = [0]
+    for text in texts:
+        for word in text.split():
+            columns.append(vocabulary.setdefault(word, len(vocabulary)))
+        pointers.append(len(columns))
+    data = np.ones(len(columns), dtype=np.float64)
+    matrix = scipy_sparse.csr_matrix((data, np.array(columns, dtype=np.int64), np.array(pointers, dtype=np.int64)), shape=(len(texts), len(vocabulary)))
+    matrix.sum_duplicates()
+    return matrix, list(vocabulary)
+
+def get_jaccard_matrix(counts : scipy_sparse.csr_matrix) -> np.ndarray:
+    vectors = (counts > 0).astype(np.float64)
+    intersection = (vectors @ vectors.T).toarray()
+    sizes = np.asarray(vectors.sum(axis=1)).ravel()
+    union = sizes[:, None] + sizes[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros(intersection.shape), where=union > 0)
+
+def get_cosine_matrix(counts : scipy_sparse.csr_matrix, vocabulary : List[str]) -> np.ndarray:
+    #CountVectorizer, which get_cosine_similarity uses, ignores one letter words.
+    vectors = counts[:, [index for index, word in enumerate(vocabulary) if len(word) > 1]]
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    vectors = scipy_sparse.diags(np.divide(1, norms, out=np.zeros(norms.shape), where=norms > 0)) @ vectors
+    return (vectors @ vectors.T).toarray()
+
+def get_prefix_matrix(texts : List[str], length : int = 6) -> np.ndarray:
+    #matrix[i, j] is whether the first `length` characters of texts[i] occur in texts[j]. Each prefix is found with
+    #str.find over one joined string, which is far cheaper than testing every pair in Python.
+    joined = "\0".join(texts)
+    starts = np.cumsum([0] + [len(text) + 1 for text in texts[:-1]])
+    matrix = np.zeros((len(texts), len(texts)), dtype=bool)
+    for row, text in enumerate(texts):
+        prefix = text[:length]
+        if prefix == "":
+            matrix[row] = True
+            continue
+        position = joined.find(prefix)
+        while position != -1:
+            column = int(np.searchsorted(starts, position, side="right")) - 1
+            matrix[row, column] = True
+            #Skip to the next text, its membership is already known.
+            position = joined.find(prefix, int(starts[column + 1]) if column + 1 < len(texts) else len(joined))
+    return matrix
+
+def like_matrix(texts : List[str], threshold_jac : float = 0.4, threshold_cos : float = 0.6) -> np.ndarray:
+    #external_datasource.like for every pair of `texts`, from two sparse matrix products instead of one fit per pair.
+    normalized = [normalize(text) for text in texts]
+    valid = [index for index, text in enumerate(normalized) if text]
+    result = np.zeros((len(texts), len(texts)), dtype=bool)
+    if len(valid) == 0:
+        return result
+    corpus = [normalized[index] for index in valid]
+    matches = get_prefix_matrix(corpus)
+    matches |= matches.T
+    counts, vocabulary = get_count_matrix(corpus)
+    matches |= get_jaccard_matrix(counts) >= threshold_jac
+    matches |= get_cosine_matrix(counts, vocabulary) >= threshold_cos
+    result[np.ix_(valid, valid)] = matches
+    np.fill_diagonal(result, False)
+    return result
+
+def deduplicate(texts : List[str], threshold_jac : float = 0.4, threshold_cos : float = 0.6) -> List[str]:
+    #Keeps the first of every group of texts that are like each other, in order.
+    if len(texts) == 0:
+        return []
+    matrix = like_matrix(texts, threshold_jac, threshold_cos)
+    kept : List[int] = []
+    for index, text in enumerate(texts):
+        if text.strip() and not matrix[index, kept].any():
+            kept.append(index)
+    return [texts[index] for index in kept]
+
+class MinHashIndex:
+    #Incremental near-duplicate index: MinHash signatures are banded into buckets, and candidates sharing a bucket
+    #are confirmed with the exact Jaccard similarity.
+    def __init__(self, threshold : float = 0.4, num_perm : int = 64, bands : int = 32, seed : int = 1):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        #a, b < 2**31 and crc32 < 2**32 keep a * h + b inside uint64.
+        generator = np.random.default_rng(seed)
+        self.a = generator.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self.b = generator.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+        self.buckets : List[Dict[bytes, List[Hashable]]] = [{} for _ in range(bands)]
+        self.tokens : Dict[Hashable, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def signature(self, tokens : Set[str]) -> np.ndarray:
+        hashes = np.array([zlib.crc32(token.encode("utf-8")) for token in tokens], dtype=np.uint64)
+        return ((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME).min(axis=0)
+
+    def band_keys(self, signature : np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def query(self, text : str) -> List[Hashable]:
+        tokens = set(normalize(text).split())
+        if len(tokens) == 0:
+            return []
+        candidates = set()
+        for band, key in enumerate(self.band_keys(self.signature(tokens))):
+            candidates.update(self.buckets[band].get(key, []))
+        return [candidate for candidate in candidates if len(tokens & self.tokens[candidate]) / len(tokens | self.tokens[candidate]) >= self.threshold]
+
+    def add(self, key : Hashable, text : str) -> None:
+        tokens = set(normalize(text).split())
+        if len(tokens) == 0 or key in self.tokens:
+            return
+        self.tokens[key] = tokens
+        for band, band_key in enumerate(self.band_keys(self.signature(tokens))):
+            self.buckets[band].setdefault(band_key, []).append(key)
+
+    def add_if_new(self, key : Hashable, text : str) -> bool:
+        #Returns False, without adding it, if `text` is a near duplicate of something already in the index.
+        if len(self.query(text)) > 0:
+            return False
+        self.add(key, text)
+        return True
+
+def benchmark(count : int = 300, seed : int = 0) -> None:
+    import random
+    from external_datasource import like
+    generator = random.Random(seed)
+    vocabulary = ["".join(generator.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(generator.randint(3, 9))) for _ in range(2000)]
+    texts : List[str] = []
+    while len(texts) < count:
+        if len(texts) > 0 and generator.random() < 0.3:
+            #A near duplicate of an earlier snippet: a few words swapped out.
+            words = generator.choice(texts).split()
+            for _ in range(2):
+                words[generator.randrange(len(words))] = generator.choice(vocabulary)
+            texts.append(" ".join(words))
+        else:
+            texts.append(" ".join(generator.choice(vocabulary) for _ in range(generator.randint(8, 30))))
+    def timed(name : str, function) -> Optional[object]:
+        start = time.perf_counter()
+        result = function()
+        print(f"{name:<28}{(time.perf_counter() - start) * 1000:10.1f} ms")
+        return result
+    print(f"{count} snippets, {count * (count - 1) // 2} pairs")
+    pairwise = timed("like() per pair", lambda: sum(like(texts[i], texts[j]) for i in range(count) for j in range(i + 1, count)))
+    matrix = timed("like_matrix()", lambda: like_matrix(texts))
+    timed("deduplicate()", lambda: deduplicate(texts))
+    def index_all():
+        index = MinHashIndex()
+        return sum(not index.add_if_new(position, text) for position, text in enumerate(texts))
+    duplicates = timed("MinHashIndex.add_if_new()", index_all)
+    print(f"like pairs: {pairwise} per pair, {int(matrix.sum()) // 2} from the matrix; near duplicates found by MinHash: {duplicates}")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,55 @@
+from __future__ import annotations
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+class ToolResultCache:
+    #Output of cacheable tools, keyed on the exact code that ran and its pip packages. Entries expire after `ttl`
+    #and the least recently used are dropped beyond `max_entries` or `max_bytes`.
+    def __init__(self, ttl : float = 600, max_entries : int = 256, max_bytes : int = 4 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries : OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_env() -> ToolResultCache:
+        return ToolResultCache(float(os.environ.get("WOPR-Tool-Cache-TTL", "600")), int(os.environ.get("WOPR-Tool-Cache-Entries", "256")), int(os.environ.get("WOPR-Tool-Cache-Bytes", str(4 * 1024 * 1024))))
+
+    def key(self, code : str, pip_packages : List[str]) -> str:
+        return hashlib.sha256((code + "\0" + "\n".join(sorted(pip_packages))).encode("utf-8")).hexdigest()
+
+    def remove(self, key : str) -> None:
+        _, output = self.entries.pop(key)
+        self.size -= len(output)
+
+    def get(self, code : str, pip_packages : List[str]) -> Optional[str]:
+        key = self.key(code, pip_packages)
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] >= self.ttl:
+            self.remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        logging.info(f"Tool result cache hit {key[:12]} ({self.hits} hits, {self.misses} misses)")
+        return entry[1]
+
+    def add(self, code : str, pip_packages : List[str], output : str) -> None:
+        if len(output) > self.max_bytes:
+            return
+        key = self.key(code, pip_packages)
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (time.monotonic(), output)
+        self.size += len(output)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
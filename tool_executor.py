@@ -0,0 +1,232 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+import asyncio
+import codecs
+from dataclasses import dataclass
+import logging
+import math
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, List, Optional
+from dto import ToolDefinition
+
+@dataclass
+class ScriptResult:
+    output:str
+    exit_code:int
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0
+
+OutputCallback = Callable[[str], Awaitable[None]]
+
+class OutputCapture:
+    #Tool output decoded as it is read. Only the first `max_bytes` are kept; the rest is counted and dropped.
+    def __init__(self, max_bytes : int = 65536):
+        self.max_bytes = max_bytes
+        self.chunks : List[str] = []
+        self.size = 0
+        self.dropped = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    def feed(self, data : bytes) -> str:
+        kept = data[:max(0, self.max_bytes - self.size)]
+        self.dropped += len(data) - len(kept)
+        self.size += len(kept)
+        text = self.decoder.decode(kept, final=self.size >= self.max_bytes)
+        if text != "":
+            self.chunks.append(text)
+        return text
+    @property
+    def output(self) -> str:
+        output = "".join(self.chunks) + self.decoder.decode(b"", final=True)
+        if self.dropped > 0:
+            output += f"\n[... {self.dropped} more bytes of output truncated]"
+        return output
+
+class ToolExecutor(ABC):
+    #Somewhere a tool's python can run; run_tool uses the first registered executor that supports the tool.
+    name = "executor"
+    max_output = int(os.environ.get("WOPR-Tool-Output-Bytes", "65536"))
+    @abstractmethod
+    def supports(self, tool : ToolDefinition) -> bool:
+        pass
+    @abstractmethod
+    async def run(self, python_code : str, dependencies : List[str], timeout : float = 60, on_output : Optional[OutputCallback] = None) -> ScriptResult:
+        pass
+
+#Runs inside the sandboxed interpreter before the tool's script. It moves into new user, mount, network and IPC
+#namespaces, builds a root holding only read-only binds of the system libraries and the interpreter (with its
+#site-packages masked), a writable /work (the run's scratch directory) and an empty /tmp, pivots into it, detaches
+#the host filesystem, and drops every capability before setting rlimits and running the script. Any step that fails
+#exits with SANDBOX_FAILED instead of running the script with less isolation. Limits are set here rather than in a
+#preexec_fn, which isn't safe in a process with threads.
+SANDBOX_FAILED = 125
+LAUNCHER = """
+import ctypes, os, platform, resource, sys, sysconfig
+cpu, memory, file_size = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+libc = ctypes.CDLL(None, use_errno=True)
+def check(result, what):
+    if result != 0:
+        sys.stderr.write(f"sandbox: {what} failed: {os.strerror(ctypes.get_errno())}\\n")
+        os._exit(%d)
+MS_RDONLY, MS_NOSUID, MS_NODEV, MS_NOEXEC, MS_REMOUNT, MS_BIND, MS_REC, MS_PRIVATE = 1, 2, 4, 8, 32, 4096, 16384, 1 << 18
+#Flags the kernel locks on mounts inherited from another user namespace, which a read-only remount has to repeat.
+LOCKED = {2: MS_NOSUID, 4: MS_NODEV, 8: MS_NOEXEC, 1024: 1024, 2048: 2048, 4096: 1 << 21}
+def mount(source, target, fstype, flags):
+    check(libc.mount(source and source.encode(), target.encode(), fstype and fstype.encode(), flags, None), "mount " + target)
+def bind(source, target, writable=False):
+    if os.path.isdir(source):
+        os.makedirs(target, exist_ok=True)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        open(target, "a").close()
+    mount(source, target, None, MS_BIND | MS_REC)
+    if not writable:
+        flags = os.statvfs(source).f_flag
+        mount(None, target, None, MS_BIND | MS_REMOUNT | MS_RDONLY | sum(value for key, value in LOCKED.items() if flags & key))
+uid, gid = os.getuid(), os.getgid()
+check(libc.unshare(0x10000000 | 0x20000 | 0x40000000 | 0x08000000), "unshare")
+for name, value in (("setgroups", "deny"), ("uid_map", f"{uid} {uid} 1"), ("gid_map", f"{gid} {gid} 1")):
+    with open("/proc/self/" + name, "w") as file:
+        file.write(value)
+mount(None, "/", None, MS_REC | MS_PRIVATE)
+root = os.path.abspath("root")
+mount("tmpfs", root, "tmpfs", MS_NOSUID | MS_NODEV)
+for path in ["/usr", "/lib", "/lib64", "/lib32", "/bin", sys.prefix, sys.base_prefix, sys.exec_prefix]:
+    real = os.path.realpath(path)
+    if os.path.islink(path) and not os.path.lexists(root + path):
+        os.makedirs(os.path.dirname(root + path), exist_ok=True)
+        os.symlink(os.readlink(path), root + path)
+    elif os.path.isdir(real) and not os.path.ismount(root + real):
+        bind(real, root + real)
+for key in ("purelib", "platlib"):
+    packages = os.path.realpath(sysconfig.get_paths()[key])
+    if os.path.isdir(root + packages) and not os.path.ismount(root + packages):
+        mount("tmpfs", root + packages, "tmpfs", MS_NOSUID | MS_NODEV | MS_RDONLY)
+for device in ("/dev/null", "/dev/zero", "/dev/random", "/dev/urandom"):
+    bind(device, root + device, writable=True)
+bind(os.path.abspath("work"), root + "/work", writable=True)
+os.makedirs(root + "/tmp")
+mount("tmpfs", root + "/tmp", "tmpfs", MS_NOSUID | MS_NODEV)
+os.makedirs(root + "/.old")
+check(libc.syscall({"x86_64": 155, "aarch64": 41}.get(platform.machine(), -1), root.encode(), (root + "/.old").encode()), "pivot_root")
+os.chdir("/")
+check(libc.umount2(b"/.old", 2), "umount")
+os.rmdir("/.old")
+mount(None, "/", None, MS_BIND | MS_REMOUNT | MS_RDONLY | MS_NOSUID | MS_NODEV)
+os.chdir("/work")
+class Header(ctypes.Structure):
+    _fields_ = [("version", ctypes.c_uint32), ("pid", ctypes.c_int)]
+class Data(ctypes.Structure):
+    _fields_ = [("effective", ctypes.c_uint32), ("permitted", ctypes.c_uint32), ("inheritable", ctypes.c_uint32)]
+check(libc.prctl(38, 1, 0, 0, 0), "no_new_privs")
+check(libc.capset(ctypes.byref(Header(0x20080522, 0)), (Data * 2)()), "capset")
+resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))
+resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+resource.setrlimit(resource.RLIMIT_FSIZE, (file_size, file_size))
+resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+del ctypes, platform, resource, sysconfig, libc
+sys.argv = ["script.py"]
+with open("script.py") as script:
+    code = compile(script.read(), "script.py", "exec")
+exec(code, {"__name__": "__main__"})
+""" % SANDBOX_FAILED
+
+class SubprocessExecutor(ToolExecutor):
+    #Standard library only tools in a local interpreter confined by LAUNCHER, with rlimits and no network. Needs
+    #unprivileged user namespaces, which `available` checks before the executor is registered.
+    name = "subprocess"
+    def __init__(self, memory : int = 512 * 1024 * 1024, file_size : int = 16 * 1024 * 1024):
+        self.memory = memory
+        self.file_size = file_size
+
+    @classmethod
+    def from_env(cls) -> SubprocessExecutor:
+        return cls(int(os.environ.get("WOPR-Tool-Subprocess-Memory", str(512 * 1024 * 1024))), int(os.environ.get("WOPR-Tool-Subprocess-File-Size", str(16 * 1024 * 1024))))
+
+    def get_command(self, timeout : float) -> List[str]:
+        return [sys.executable, "-I", "-S", "-u", "-c", LAUNCHER, str(math.ceil(timeout) + 1), str(self.memory), str(self.file_size)]
+
+    def available(self) -> bool:
+        with tempfile.TemporaryDirectory(prefix="wopr-tool-") as scratch:
+            os.mkdir(os.path.join(scratch, "work"))
+            os.mkdir(os.path.join(scratch, "root"))
+            with open(os.path.join(scratch, "work", "script.py"), "w") as file:
+                file.write("import os\nprint(sorted(os.listdir('/')))")
+            try:
+                result = subprocess.run(self.get_command(10), cwd=scratch, env={"PATH": "/usr/bin:/bin"}, stdin=subprocess.DEVNULL, capture_output=True, timeout=20)
+            except subprocess.TimeoutExpired:
+                return False
+        if result.returncode != 0:
+            logging.warning(f"Subprocess tool sandbox is unavailable: {result.stderr.decode('utf-8', errors='replace').strip()}")
+        return result.returncode == 0
+
+    def supports(self, tool : ToolDefinition) -> bool:
+        return len(tool.pip_packages) == 0 and not tool.needs_network
+
+    async def run(self, python_code : str, dependencies : List[str], timeout : float = 60, on_output : Optional[OutputCallback] = None) -> ScriptResult:
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory(prefix="wopr-tool-") as scratch:
+            #work becomes /work in the sandbox; root is only a mount point for the sandbox's root.
+            os.mkdir(os.path.join(scratch, "work"))
+            os.mkdir(os.path.join(scratch, "root"))
+            with open(os.path.join(scratch, "work", "script.py"), "w") as file:
+                file.write(python_code)
+            process = await asyncio.create_subprocess_exec(*self.get_command(timeout), cwd=scratch, env={"PATH": "/usr/bin:/bin", "HOME": "/work", "TMPDIR": "/tmp"},
+                                                           stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+            capture = OutputCapture(self.max_output)
+            async def pump():
+                while True:
+                    chunk = await process.stdout.read(4096)
+                    if not chunk:
+                        break
+                    text = capture.feed(chunk)
+                    if on_output is not None and text != "":
+                        await on_output(text)
+                await process.wait()
+            try:
+                await asyncio.wait_for(pump(), timeout)
+            finally:
+                #Also reaps anything the script started in the background.
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        logging.info(f"Subprocess tool run exited with {process.returncode} in {time.perf_counter() - start:.3f}s")
+        return ScriptResult(capture.output, process.returncode)
+
+executors : List[ToolExecutor] = []
+
+def register_executor(executor : ToolExecutor) -> None:
+    #Register cheaper executors first, the first one that supports a tool wins.
+    executors.append(executor)
+
+def select_executor(tool : ToolDefinition) -> ToolExecutor:
+    for executor in executors:
+        if executor.supports(tool):
+            return executor
+    raise ValueError("No executor can run " + tool.name)
+
+#Off by default: it runs generated code on the bot's own host, so only enable it where the sandbox can be built.
+if os.environ.get("WOPR-Tool-Subprocess", "false").lower() == "true":
+    subprocess_executor = SubprocessExecutor.from_env()
+    if subprocess_executor.available():
+        register_executor(subprocess_executor)
+
+if __name__ == "__main__":
+    async def main():
+        executor = SubprocessExecutor()
+        print("sandbox available:", executor.available())
+        for code in ["print(sum(range(10)))", "print('x' * 100000)", "import socket\nsocket.create_connection(('example.com', 80))", "import os\nprint(sorted(os.listdir('/')))",
+                     "open('/work/../../etc/passwd').read()", "import os\nos.remove('/usr/bin/env')", "while True: pass"]:
+            start = time.perf_counter()
+            try:
+                result = await executor.run(code, [], timeout=2)
+                print(f"{time.perf_counter() - start:.3f}s exit {result.exit_code}: {result.output.strip().splitlines()[-1:]}")
+            except asyncio.TimeoutError:
+                print(f"{time.perf_counter() - start:.3f}s timed out")
+    asyncio.run(main())
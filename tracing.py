@@ -0,0 +1,137 @@
+from __future__ import annotations
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+from dataclasses import dataclass, field
+import functools
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+from uuid import uuid4
+
+@dataclass
+class Span:
+    name:str
+    trace_id:str
+    span_id:str
+    parent_id:Optional[str]
+    start:float
+    end:Optional[float] = None
+    tags:Dict[str, Any] = field(default_factory=dict)
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.time()) - self.start
+
+@dataclass
+class Trace:
+    root:Span
+    spans:List[Span] = field(default_factory=list)
+    def summary(self, limit : int = 8) -> str:
+        children = sorted((span for span in self.spans if span is not self.root), key=lambda span: span.duration, reverse=True)[:limit]
+        return ", ".join(f"{span.name} {span.duration * 1000:.0f}ms" for span in children)
+
+current_span : contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+current_trace : contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+
+class Tracer:
+    #Spans per message, parented through context variables. Slow traces are logged and kept in a ring, and with
+    #`path` set traces are appended as Chrome trace events, rotated to `path`.1 at `max_bytes`.
+    def __init__(self, path : Optional[str] = None, slow_threshold : float = 2.0, ring_size : int = 50, max_bytes : int = 64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.slow_threshold = slow_threshold
+        self.slow : Deque[Trace] = deque(maxlen=ring_size)
+        self.lock = threading.Lock()
+        self.rows = itertools.count(1)
+
+    @classmethod
+    def from_env(cls) -> Tracer:
+        return cls(os.environ.get("WOPR-Trace-File") or None, float(os.environ.get("WOPR-Trace-Slow-Ms", "2000")) / 1000, int(os.environ.get("WOPR-Trace-Ring", "50")),
+                   int(os.environ.get("WOPR-Trace-Max-Bytes", str(64 * 1024 * 1024))))
+
+    @contextmanager
+    def span(self, name : str, root : bool = True, **tags : Any) -> Iterator[Optional[Span]]:
+        #With root=False the span is only recorded inside an existing trace, for stages that also run on their own.
+        parent = current_span.get()
+        trace = current_trace.get()
+        if trace is None and not root:
+            yield None
+            return
+        span = Span(name, trace.root.trace_id if trace is not None else uuid4().hex, uuid4().hex[:16], parent.span_id if parent is not None else None, time.time(), tags=tags)
+        trace_token = None
+        if trace is None:
+            trace = Trace(span)
+            trace_token = current_trace.set(trace)
+        trace.spans.append(span)
+        span_token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.tags["error"] = repr(e)
+            raise
+        finally:
+            span.end = time.time()
+            current_span.reset(span_token)
+            if trace_token is not None:
+                current_trace.reset(trace_token)
+                self.finish(trace)
+
+    def traced(self, name : Optional[str] = None) -> Callable:
+        #Decorates an async function so every call is a span.
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(name or func.__qualname__):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def tag(self, **tags : Any) -> None:
+        span = current_span.get()
+        if span is not None:
+            span.tags.update(tags)
+
+    def tag_trace(self, **tags : Any) -> None:
+        trace = current_trace.get()
+        if trace is not None:
+            trace.root.tags.update(tags)
+
+    def finish(self, trace : Trace) -> None:
+        if trace.root.duration >= self.slow_threshold:
+            self.slow.append(trace)
+            logging.warning(f"Slow trace {trace.root.name} {trace.root.duration * 1000:.0f}ms {trace.root.tags}: {trace.summary()}")
+        if self.path is not None:
+            self.export(trace)
+
+    def export(self, trace : Trace) -> None:
+        row = next(self.rows)
+        events = []
+        for span in trace.spans:
+            events.append(json.dumps({"name": span.name, "cat": "wopr", "ph": "X", "ts": int(span.start * 1e6), "dur": int(span.duration * 1e6), "pid": os.getpid(), "tid": row,
+                                      "args": dict(span.tags, trace_id=span.trace_id, span_id=span.span_id, parent_id=span.parent_id)}, default=str))
+        data = ",\n".join(events) + ",\n"
+        try:
+            with self.lock:
+                size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+                if size >= self.max_bytes:
+                    #Another process may have rotated it first, in which case this moves a fresh file; both are valid traces.
+                    os.replace(self.path, self.path + ".1")
+                    size = 0
+                new = size == 0
+                #One write per trace with O_APPEND, so worker processes sharing the file don't interleave.
+                descriptor = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(descriptor, (("[\n" if new else "") + data).encode("utf-8"))
+                finally:
+                    os.close(descriptor)
+        except OSError as e:
+            logging.warning(f"Could not export trace: {e}")
+
+    def slow_traces(self) -> List[Trace]:
+        return sorted(self.slow, key=lambda trace: trace.root.duration, reverse=True)
+
+tracer = Tracer.from_env()
@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import sys
+import traceback
+from types import SimpleNamespace
+from db import Database
+from llm_metrics import metrics
+from message_handler import MessageHandler
+from message_queue import STREAM_LIMIT, QueueSendable, decode_message, read_frame, write_frame
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - worker - %(name)s - %(levelname)s - %(message)s')
+
+async def run_job(handler : MessageHandler, database : Database, frame : dict, writer : asyncio.StreamWriter, lock : asyncio.Lock) -> None:
+    sendable = QueueSendable(frame["job"], writer, lock)
+    error = None
+    try:
+        await handler.handle_message(decode_message(frame["message"]), database, sendable)
+    except Exception:
+        error = traceback.format_exc()
+        logging.error(error)
+    await sendable.emit({"type": "finished", "error": error})
+
+async def run_worker(socket_path : str, db_path : str, index : int) -> None:
+    database = Database(db_path)
+    handler = MessageHandler()
+    metrics.serve_from_env(index + 1)
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=STREAM_LIMIT)
+    lock = asyncio.Lock()
+    await write_frame(writer, {"type": "hello", "worker": index})
+    logging.info(f"Worker {index} ready")
+    tasks = set()
+    while True:
+        frame = await read_frame(reader)
+        if frame is None:
+            break
+        if frame["type"] == "job":
+            task = asyncio.create_task(run_job(handler, database, frame, writer, lock))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        elif frame["type"] == "prefetch":
+            task = asyncio.create_task(database.prefetch_async(SimpleNamespace(id=frame["user_id"])))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        elif frame["type"] == "invalidate":
+            database.invalidate(frame["user_id"])
+    logging.info(f"Worker {index} lost the gateway, exiting")
+
+if __name__ == "__main__":
+    asyncio.run(run_worker(sys.argv[1], sys.argv[2], int(sys.argv[3])))